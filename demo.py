@@ -2,8 +2,9 @@
 Demo script for Invoice Processing Workflow
 Shows end-to-end execution with sample invoice
 """
-import json
 import logging
+import sys
+import orjson
 from datetime import datetime, timedelta
 from src.schemas import InvoicePayload, LineItem, WorkflowStatusEnum, WorkflowState
 from src.workflow import create_workflow_state, invoice_processing_workflow
@@ -44,7 +45,7 @@ def print_section(title: str):
 def print_stage_result(stage_name: str, output: dict):
     """Print stage execution result"""
     print(f"\n[{stage_name}]")
-    print(json.dumps(output, indent=2, default=str))
+    print(orjson.dumps(output, option=orjson.OPT_INDENT_2).decode())
 
 
 def run_demo():
@@ -71,16 +72,21 @@ def run_demo():
     try:
         final_state = invoice_processing_workflow.invoke(state)
         
-        # Convert dict to WorkflowState if needed
+        # Convert dict to WorkflowState if needed; the graph already validated
+        # each stage output, so skip revalidating the whole state
         if isinstance(final_state, dict):
-            final_state = WorkflowState(**final_state)
+            final_state = WorkflowState.model_construct(**final_state)
         
         # Print execution log
         print_section("EXECUTION LOG")
+        # Stream straight to the byte buffer; flush text output first to keep ordering
+        sys.stdout.flush()
+        write = sys.stdout.buffer.write
         for i, log_entry in enumerate(final_state.execution_log, 1):
-            print(f"\n[{i}] {log_entry.stage} - {log_entry.action}")
-            print(f"    Time: {log_entry.timestamp}")
-            print(f"    Details: {json.dumps(log_entry.details, indent=6, default=str)}")
+            write(f"\n[{i}] {log_entry.stage} - {log_entry.action}\n    Time: {log_entry.timestamp}\n    Details: ".encode())
+            write(orjson.dumps(log_entry.details, option=orjson.OPT_INDENT_2))
+            write(b"\n")
+        sys.stdout.buffer.flush()
         
         # Print tool selections
         print_section("BIGTOOL SELECTIONS")
@@ -108,7 +114,7 @@ def run_demo():
                     "normalized_name": final_state.prepare_output.vendor_profile.normalized_name,
                     "tax_id": final_state.prepare_output.vendor_profile.tax_id,
                 },
-                "flags": final_state.prepare_output.flags.model_dump(),
+                "flags": final_state.prepare_output.flags,
             })
         
         if final_state.retrieve_output:
@@ -137,7 +143,7 @@ def run_demo():
         if final_state.reconcile_output:
             print_stage_result("RECONCILE", {
                 "accounting_entries_count": len(final_state.reconcile_output.accounting_entries),
-                "reconciliation_report": final_state.reconcile_output.reconciliation_report.model_dump(),
+                "reconciliation_report": final_state.reconcile_output.reconciliation_report,
             })
         
         if final_state.approve_output:
@@ -155,7 +161,7 @@ def run_demo():
         
         if final_state.notify_output:
             print_stage_result("NOTIFY", {
-                "notify_status": final_state.notify_output.notify_status.model_dump(),
+                "notify_status": final_state.notify_output.notify_status,
                 "notified_parties": final_state.notify_output.notified_parties,
             })
         
@@ -163,7 +169,7 @@ def run_demo():
         if final_state.complete_output:
             print_section("FINAL PAYLOAD")
             final_payload = final_state.complete_output.final_payload.model_dump()
-            print(json.dumps(final_payload, indent=2, default=str))
+            print(orjson.dumps(final_payload, option=orjson.OPT_INDENT_2).decode())
         
         # Summary
         print_section("WORKFLOW SUMMARY")
@@ -177,7 +183,7 @@ def run_demo():
         print_section("DEMO COMPLETED SUCCESSFULLY")
         
     except Exception as e:
-        logger.error(f"Error during workflow execution: {e}", exc_info=True)
+        logger.error("Error during workflow execution: %s", e, exc_info=True)
         print_section("ERROR OCCURRED")
         print(f"Error: {str(e)}")
         raise
@@ -2,7 +2,7 @@
 Bigtool implementation for dynamic tool selection
 """
 import logging
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List
 from src.config import settings
 
 logger = logging.getLogger(__name__)
@@ -17,54 +17,75 @@ class BigtoolPicker:
         # In production, this would use ML to select based on context
         # For now, use default
         selected = settings.DEFAULT_OCR_TOOL
-        logger.info(f"BigtoolPicker: Selected OCR tool: {selected}")
+        logger.info(
+            "BigtoolPicker: Selected OCR tool: %s", selected,
+            extra={"capability": "ocr", "tool": selected},
+        )
         return selected
     
     @staticmethod
     def select_enrichment_tool(context: Dict[str, Any] = None) -> str:
         """Select enrichment tool from pool"""
         selected = settings.DEFAULT_ENRICHMENT_TOOL
-        logger.info(f"BigtoolPicker: Selected enrichment tool: {selected}")
+        logger.info(
+            "BigtoolPicker: Selected enrichment tool: %s", selected,
+            extra={"capability": "enrichment", "tool": selected},
+        )
         return selected
     
     @staticmethod
     def select_erp_tool(context: Dict[str, Any] = None) -> str:
         """Select ERP connector tool from pool"""
         selected = settings.DEFAULT_ERP_TOOL
-        logger.info(f"BigtoolPicker: Selected ERP tool: {selected}")
+        logger.info(
+            "BigtoolPicker: Selected ERP tool: %s", selected,
+            extra={"capability": "erp_connector", "tool": selected},
+        )
         return selected
     
     @staticmethod
     def select_db_tool(context: Dict[str, Any] = None) -> str:
         """Select database tool from pool"""
         selected = settings.DEFAULT_DB_TOOL
-        logger.info(f"BigtoolPicker: Selected DB tool: {selected}")
+        logger.info(
+            "BigtoolPicker: Selected DB tool: %s", selected,
+            extra={"capability": "db", "tool": selected},
+        )
         return selected
     
     @staticmethod
     def select_email_tool(context: Dict[str, Any] = None) -> str:
         """Select email tool from pool"""
         selected = settings.DEFAULT_EMAIL_TOOL
-        logger.info(f"BigtoolPicker: Selected email tool: {selected}")
+        logger.info(
+            "BigtoolPicker: Selected email tool: %s", selected,
+            extra={"capability": "email", "tool": selected},
+        )
         return selected
     
-    @staticmethod
-    def select(capability: str, context: Dict[str, Any] = None) -> str:
+    # Capability -> selector; built once after the class, not per select() call
+    _CAPABILITY_MAP: Dict[str, Callable[[Dict[str, Any]], str]] = {}
+    
+    @classmethod
+    def select(cls, capability: str, context: Dict[str, Any] = None) -> str:
         """Generic select method for any capability"""
-        capability_map = {
-            "ocr": BigtoolPicker.select_ocr_tool,
-            "enrichment": BigtoolPicker.select_enrichment_tool,
-            "erp_connector": BigtoolPicker.select_erp_tool,
-            "db": BigtoolPicker.select_db_tool,
-            "storage": BigtoolPicker.select_db_tool,
-            "email": BigtoolPicker.select_email_tool,
-        }
-        
-        if capability in capability_map:
-            return capability_map[capability](context)
-        else:
-            logger.warning(f"Unknown capability: {capability}")
-            return  "unknown_tool"
+        fn = cls._CAPABILITY_MAP.get(capability)
+        if fn is not None:
+            return fn(context)
+        logger.warning("Unknown capability: %s", capability)
+        return "unknown_tool"
+
+
+# Filled in once the class exists: inside the class body the selectors are
+# still staticmethod objects, which are only callable from Python 3.10 on
+BigtoolPicker._CAPABILITY_MAP.update({
+    "ocr": BigtoolPicker.select_ocr_tool,
+    "enrichment": BigtoolPicker.select_enrichment_tool,
+    "erp_connector": BigtoolPicker.select_erp_tool,
+    "db": BigtoolPicker.select_db_tool,
+    "storage": BigtoolPicker.select_db_tool,
+    "email": BigtoolPicker.select_email_tool,
+})
 
 
 class MCPClient:
@@ -83,7 +104,7 @@ class MCPClient:
     
     async def call_ability(self, ability_name: str, params: Dict[str, Any]) -> Dict[str, Any]:
         """Call an ability on the MCP server"""
-        logger.info(f"MCP[{self.server_type}]: Calling ability '{ability_name}' with params: {params}")
+        logger.info("MCP[%s]: Calling ability '%s' with params: %s", self.server_type, ability_name, params)
         
         # Mock implementation - in production, this would make actual HTTP calls
         result = {
@@ -0,0 +1,87 @@
+"""
+In-process TTL cache for read-heavy API responses
+"""
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# Cache key for the /human-review/pending listing
+PENDING_REVIEWS_KEY = "reviews:pending"
+
+
+class TTLCache:
+    """
+    Thread-safe mapping whose entries expire a fixed time after being set.
+    The cache is per process: with several API workers each keeps its own
+    copy and delete() only reaches the calling worker, so entries that must
+    be invalidated on writes are only safe to cache on a single worker. With
+    max_entries set, the oldest entry is dropped to make room for a new one.
+    """
+
+    def __init__(self, default_ttl: float = 60.0, max_entries: Optional[int] = None):
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self._data: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Cached value for key, or default if missing or expired"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            with self._lock:
+                if self._data.get(key) is entry:
+                    del self._data[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Store value under key for ttl seconds"""
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            if self.max_entries is not None and len(self._data) >= self.max_entries:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (expires_at, value)
+
+    def delete(self, key: Hashable) -> None:
+        """Drop key if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
+
+
+# Global response cache
+response_cache = TTLCache()
+
+
+# Bumped by every invalidation, so a listing read from the database before
+# the queue changed is not cached after the change dropped the old one
+_pending_reviews_generation = 0
+_pending_reviews_lock = threading.Lock()
+
+
+def pending_reviews_generation() -> int:
+    """Current invalidation count; read it before querying the queue"""
+    return _pending_reviews_generation
+
+
+def cache_pending_reviews(body: Any, generation: int, ttl: Optional[float] = None) -> None:
+    """Cache a listing unless the queue was invalidated since `generation`"""
+    with _pending_reviews_lock:
+        if generation == _pending_reviews_generation:
+            response_cache.set(PENDING_REVIEWS_KEY, body, ttl)
+
+
+def invalidate_pending_reviews() -> None:
+    """Forget this process's cached pending-review listing after the queue changes"""
+    global _pending_reviews_generation
+    with _pending_reviews_lock:
+        _pending_reviews_generation += 1
+        response_cache.delete(PENDING_REVIEWS_KEY)
@@ -1,22 +1,44 @@
 """
 Configuration for Invoice Processing Workflow
 """
-from pydantic_settings import BaseSettings
+import logging
+import os
+from functools import lru_cache
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional, Dict, List
 
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True, frozen=True)
+    
     # API & Server
     API_HOST: str = "0.0.0.0"
     API_PORT: int = 8000
     API_DEBUG: bool = True
+    API_WORKERS: Optional[int] = None  # Defaults to one per CPU when not debugging
     
     # Gemini LLM
     GEMINI_API_KEY: str
     GEMINI_MODEL: str = "gemini-2.5-flash"
+    GEMINI_MAX_INFLIGHT: int = 8  # Concurrent Gemini requests per process
+    GEMINI_RPS: float = 10.0  # Sustained Gemini requests per second per process
+    GEMINI_MAX_ATTEMPTS: int = 3  # Tries per call on rate limits and transient errors
+    
+    # Logging
+    LOG_LEVEL: str = "INFO"
     
     # Database
     DATABASE_URL: str = "sqlite:///./invoice_processing.db"
+    DB_POOL_SIZE: int = 25
+    DB_MAX_OVERFLOW: int = 25
+    
+    # LLM response caching
+    ACCOUNTING_CACHE_TTL: float = 7 * 24 * 3600.0  # Seconds generated entries are reused
+    ACCOUNTING_CACHE_MAX_ENTRIES: int = 10000
+    
+    # Accounting-entry request batching
+    ACCOUNTING_BATCH_SIZE: int = 8  # Invoices per batched LLM call
+    ACCOUNTING_BATCH_MAX_WAIT: float = 0.05  # Seconds to wait for a batch to fill
     
     # Workflow Config
     MATCH_THRESHOLD: float = 0.90
@@ -26,6 +48,11 @@ class Settings(BaseSettings):
     # Queue & Checkpoint
     HUMAN_REVIEW_QUEUE_TABLE: str = "human_review_queue"
     CHECKPOINT_TABLE: str = "checkpoints"
+    # Seconds a pending-review listing is reused. Cached only on a single API
+    # worker (api_worker_count). Start the API with `python -m src.main`, or
+    # when running `uvicorn --workers N` directly set WEB_CONCURRENCY=N
+    # instead of passing --workers, so the cache is turned off.
+    PENDING_REVIEWS_CACHE_TTL: float = 20.0
     
     # MCP Servers (mock for now)
     COMMON_SERVER_URL: str = "http://localhost:8001"
@@ -45,9 +72,39 @@ class Settings(BaseSettings):
     DEFAULT_DB_TOOL: str = "sqlite"
     DEFAULT_EMAIL_TOOL: str = "sendgrid"
     
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+    @property
+    def api_worker_count(self) -> int:
+        """Worker processes the API is started with"""
+        # uvicorn's CLI takes its default --workers from WEB_CONCURRENCY
+        web_concurrency = os.environ.get("WEB_CONCURRENCY")
+        if web_concurrency:
+            return int(web_concurrency)
+        if self.API_DEBUG:
+            return 1  # reload needs a single worker
+        return self.API_WORKERS or os.cpu_count() or 1
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Parse .env and the environment once per process"""
+    return Settings()
+
+
+def configure_logging(level: Optional[str] = None) -> None:
+    """Send all records to one stream handler that renders JSON with orjson"""
+    from pythonjsonlogger.orjson import OrjsonFormatter
+    
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        OrjsonFormatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    )
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or get_settings().LOG_LEVEL)
 
 
-settings = Settings()
+def __getattr__(name: str):
+    # `settings` is resolved on first access rather than at import
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
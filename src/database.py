@@ -1,19 +1,100 @@
 """
 Database models and utilities for checkpoint persistence
 """
-from sqlalchemy import create_engine, Column, String, Float, DateTime, Text, JSON, Boolean
+import atexit
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+from typing import Iterator, List, Optional, Tuple
+from sqlalchemy import create_engine, event, func, insert, inspect, select, text as sql_text, Column, Index, String, Float, DateTime, Text, Boolean, LargeBinary
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy import types as sqltypes
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from sqlalchemy.orm import Session, defer, sessionmaker
 import json
+import orjson
+import zstandard as zstd
 from src.config import settings
 
+logger = logging.getLogger(__name__)
+
 # Database setup
-engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {})
+if "sqlite" in settings.DATABASE_URL:
+    _engine_kwargs = {"connect_args": {"check_same_thread": False}}
+else:
+    # API handlers run in a threadpool; size the pool so they don't queue on it
+    _engine_kwargs = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+    }
+engine = create_engine(settings.DATABASE_URL, pool_pre_ping=False, **_engine_kwargs)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL journaling with NORMAL sync avoids an fsync per commit"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+class FastJSON(TypeDecorator):
+    """JSON column stored as JSONB on PostgreSQL and orjson bytes elsewhere"""
+    impl = LargeBinary
+    cache_ok = True
+    
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(LargeBinary())
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return orjson.dumps(value)
+    
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        if isinstance(value, (dict, list)):
+            # Already decoded by a driver-level JSON type
+            return value
+        # orjson bytes, or JSON text in rows written by the old JSON column
+        return orjson.loads(value)
+
+
+class UTCDateTime(TypeDecorator):
+    """
+    Timezone-aware UTC timestamp on every dialect. Naive values are taken to
+    be UTC when written, and values read back (naive on SQLite) come out
+    aware, so isoformat() has the same shape whatever the database.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+
 class CheckpointModel(Base):
     """Model for storing workflow checkpoints"""
     __tablename__ = settings.CHECKPOINT_TABLE
@@ -24,20 +105,23 @@ class CheckpointModel(Base):
     vendor_name = Column(String)
     amount = Column(Float)
     currency = Column(String)
-    state_blob = Column(JSON)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    state_blob = Column(LargeBinary)  # orjson-encoded, see encode_state_blob()
+    created_at = Column(UTCDateTime, server_default=func.now())
     reason_for_hold = Column(String)
     review_url = Column(String)
     status = Column(String, default="PENDING")
     reviewer_id = Column(String, nullable=True)
     decision = Column(String, nullable=True)
     decision_notes = Column(String, nullable=True)
-    decided_at = Column(DateTime, nullable=True)
+    decided_at = Column(UTCDateTime, nullable=True)
 
 
 class HumanReviewQueueModel(Base):
     """Model for human review queue"""
     __tablename__ = settings.HUMAN_REVIEW_QUEUE_TABLE
+    __table_args__ = (
+        Index("ix_hrq_status_created", "status", "created_at"),
+    )
     
     id = Column(String, primary_key=True, index=True)
     checkpoint_id = Column(String, index=True)
@@ -45,10 +129,10 @@ class HumanReviewQueueModel(Base):
     vendor_name = Column(String)
     amount = Column(Float)
     currency = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(UTCDateTime, server_default=func.now())
     reason_for_hold = Column(String)
     review_url = Column(String)
-    status = Column(String, default="PENDING")
+    status = Column(String, default="PENDING", index=True)
 
 
 class AuditLogModel(Base):
@@ -58,14 +142,66 @@ class AuditLogModel(Base):
     id = Column(String, primary_key=True, index=True)
     workflow_id = Column(String, index=True)
     invoice_id = Column(String, index=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(UTCDateTime, server_default=func.now())
     stage = Column(String)
     action = Column(String)
-    details = Column(JSON)
+    details = Column(FastJSON)
+
+
+def upgrade_legacy_schema(bind=engine) -> None:
+    """
+    Bring tables created by earlier versions to the current column types.
+    create_all() creates missing tables but never alters existing ones.
+    Idempotent: columns that already have the current type are left alone.
+    On SQLite, column types are not enforced, so legacy rows stay as they
+    are and are decoded on read instead (see decode_state_blob() and FastJSON).
+    """
+    if bind.dialect.name != "postgresql":
+        return
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        checkpoint_table = CheckpointModel.__tablename__
+        columns = {c["name"]: c["type"] for c in inspector.get_columns(checkpoint_table)}
+        state_blob_type = columns.get("state_blob")
+        if state_blob_type is not None and not isinstance(state_blob_type, sqltypes.LargeBinary):
+            # JSON rows become headerless JSON bytes, which decode_state_blob() reads
+            logger.info("Converting %s.state_blob to bytea", checkpoint_table)
+            conn.execute(sql_text(
+                f"ALTER TABLE {checkpoint_table} ALTER COLUMN state_blob TYPE bytea "
+                f"USING convert_to(state_blob::text, 'UTF8')"
+            ))
+        
+        columns = {c["name"]: c["type"] for c in inspector.get_columns(AuditLogModel.__tablename__)}
+        details_type = columns.get("details")
+        if details_type is not None and not isinstance(details_type, JSONB):
+            # json and jsonb hold the same documents; the cast keeps every row
+            logger.info("Converting %s.details to jsonb", AuditLogModel.__tablename__)
+            conn.execute(sql_text(
+                f"ALTER TABLE {AuditLogModel.__tablename__} ALTER COLUMN details TYPE jsonb "
+                f"USING details::jsonb"
+            ))
+        
+        # Timestamps were naive UTC before the columns became timezone-aware
+        for model in (CheckpointModel, HumanReviewQueueModel, AuditLogModel):
+            table = model.__tablename__
+            for column in inspector.get_columns(table):
+                name = column["name"]
+                model_column = model.__table__.c.get(name)
+                if (
+                    model_column is not None
+                    and isinstance(model_column.type, UTCDateTime)
+                    and not getattr(column["type"], "timezone", True)
+                ):
+                    logger.info("Converting %s.%s to timestamptz", table, name)
+                    conn.execute(sql_text(
+                        f"ALTER TABLE {table} ALTER COLUMN {name} TYPE timestamptz "
+                        f"USING {name} AT TIME ZONE 'UTC'"
+                    ))
 
 
 # Create tables
 Base.metadata.create_all(bind=engine)
+upgrade_legacy_schema()
 
 
 def get_db():
@@ -77,36 +213,106 @@ def get_db():
         db.close()
 
 
-def save_checkpoint(checkpoint_data: dict) -> str:
-    """Save checkpoint to database"""
+# Naive datetimes in a state blob are UTC (the workflow stamps in UTC)
+STATE_BLOB_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
+# First byte of a stored blob says how the rest is encoded. Blobs written
+# before the header existed are bare JSON and start with "{".
+_BLOB_RAW = b"\x00"
+_BLOB_ZSTD = b"\x01"
+# Below this size compression saves less than it costs
+_BLOB_COMPRESS_MIN_BYTES = 1024
+_BLOB_ZSTD_LEVEL = 3
+
+
+def encode_state_blob(state_blob) -> bytes:
+    """Serialize a checkpoint state blob to JSON, zstd-compressed once large"""
+    if isinstance(state_blob, bytes):
+        # Already encoded (JSON bytes without a header still decode)
+        return state_blob
+    data = orjson.dumps(state_blob, option=STATE_BLOB_OPTIONS)
+    if len(data) < _BLOB_COMPRESS_MIN_BYTES:
+        return _BLOB_RAW + data
+    return _BLOB_ZSTD + zstd.compress(data, _BLOB_ZSTD_LEVEL)
+
+
+def decode_state_blob(raw: Optional[bytes]) -> Optional[dict]:
+    """Deserialize a checkpoint state blob written by encode_state_blob()"""
+    if raw is None:
+        return None
+    if isinstance(raw, dict):
+        # A JSON column not yet converted by upgrade_legacy_schema()
+        return raw
+    if isinstance(raw, str):
+        # Legacy JSON text (SQLite rows written before the column was binary)
+        return orjson.loads(raw)
+    raw = bytes(raw)
+    header, body = raw[:1], raw[1:]
+    if header == _BLOB_ZSTD:
+        return orjson.loads(zstd.decompress(body))
+    if header == _BLOB_RAW:
+        return orjson.loads(body)
+    return orjson.loads(raw)
+
+
+@contextmanager
+def _session_scope(db: Optional[Session] = None) -> Iterator[Session]:
+    """Use the caller's session if given, otherwise a short-lived one"""
+    if db is not None:
+        yield db
+        return
     db = SessionLocal()
     try:
-        checkpoint = CheckpointModel(
-            checkpoint_id=checkpoint_data["checkpoint_id"],
-            workflow_id=checkpoint_data["workflow_id"],
-            invoice_id=checkpoint_data["invoice_id"],
-            vendor_name=checkpoint_data["vendor_name"],
-            amount=checkpoint_data["amount"],
-            currency=checkpoint_data["currency"],
-            state_blob=checkpoint_data["state_blob"],
-            reason_for_hold=checkpoint_data["reason_for_hold"],
-            review_url=checkpoint_data["review_url"],
-        )
-        db.add(checkpoint)
-        db.commit()
-        db.refresh(checkpoint)
-        return checkpoint.checkpoint_id
+        yield db
     finally:
         db.close()
 
 
-def get_checkpoint(checkpoint_id: str) -> dict:
+def _checkpoint_row(checkpoint_data: dict) -> CheckpointModel:
+    return CheckpointModel(
+        checkpoint_id=checkpoint_data["checkpoint_id"],
+        workflow_id=checkpoint_data["workflow_id"],
+        invoice_id=checkpoint_data["invoice_id"],
+        vendor_name=checkpoint_data["vendor_name"],
+        amount=checkpoint_data["amount"],
+        currency=checkpoint_data["currency"],
+        state_blob=encode_state_blob(checkpoint_data["state_blob"]),
+        reason_for_hold=checkpoint_data["reason_for_hold"],
+        review_url=checkpoint_data["review_url"],
+    )
+
+
+def _review_queue_row(queue_data: dict) -> HumanReviewQueueModel:
+    return HumanReviewQueueModel(
+        id=queue_data["id"],
+        checkpoint_id=queue_data["checkpoint_id"],
+        invoice_id=queue_data["invoice_id"],
+        vendor_name=queue_data["vendor_name"],
+        amount=queue_data["amount"],
+        currency=queue_data["currency"],
+        reason_for_hold=queue_data["reason_for_hold"],
+        review_url=queue_data["review_url"],
+    )
+
+
+def save_checkpoint(checkpoint_data: dict, db: Optional[Session] = None) -> str:
+    """Save checkpoint to database"""
+    with _session_scope(db) as db:
+        db.add(_checkpoint_row(checkpoint_data))
+        db.commit()
+        return checkpoint_data["checkpoint_id"]
+
+
+def get_checkpoint(checkpoint_id: str, db: Optional[Session] = None, include_state_blob: bool = True) -> dict:
     """Retrieve checkpoint from database"""
-    db = SessionLocal()
-    try:
-        checkpoint = db.query(CheckpointModel).filter(
+    with _session_scope(db) as db:
+        query = db.query(CheckpointModel).filter(
             CheckpointModel.checkpoint_id == checkpoint_id
-        ).first()
+        )
+        if not include_state_blob:
+            # Metadata-only callers skip loading and decoding the blob
+            query = query.options(defer(CheckpointModel.state_blob))
+        checkpoint = query.first()
         if checkpoint:
             return {
                 "checkpoint_id": checkpoint.checkpoint_id,
@@ -115,7 +321,7 @@ def get_checkpoint(checkpoint_id: str) -> dict:
                 "vendor_name": checkpoint.vendor_name,
                 "amount": checkpoint.amount,
                 "currency": checkpoint.currency,
-                "state_blob": checkpoint.state_blob,
+                "state_blob": decode_state_blob(checkpoint.state_blob) if include_state_blob else None,
                 "created_at": checkpoint.created_at.isoformat(),
                 "reason_for_hold": checkpoint.reason_for_hold,
                 "review_url": checkpoint.review_url,
@@ -126,77 +332,83 @@ def get_checkpoint(checkpoint_id: str) -> dict:
                 "decided_at": checkpoint.decided_at.isoformat() if checkpoint.decided_at else None,
             }
         return None
-    finally:
-        db.close()
 
 
-def update_checkpoint_decision(checkpoint_id: str, decision: str, reviewer_id: str, notes: str = ""):
+def update_checkpoint_decision(checkpoint_id: str, decision: str, reviewer_id: str, notes: str = "", db: Optional[Session] = None):
     """Update checkpoint with human decision"""
-    db = SessionLocal()
-    try:
-        checkpoint = db.query(CheckpointModel).filter(
+    with _session_scope(db) as db:
+        checkpoint = db.query(CheckpointModel).options(
+            defer(CheckpointModel.state_blob)
+        ).filter(
             CheckpointModel.checkpoint_id == checkpoint_id
         ).first()
         if checkpoint:
             checkpoint.decision = decision
             checkpoint.reviewer_id = reviewer_id
             checkpoint.decision_notes = notes
-            checkpoint.decided_at = datetime.utcnow()
+            checkpoint.decided_at = func.now()
             checkpoint.status = "DECIDED"
             db.commit()
-    finally:
-        db.close()
 
 
-def get_pending_reviews() -> list:
+def get_pending_reviews(db: Optional[Session] = None) -> list:
     """Get all pending human reviews"""
-    db = SessionLocal()
-    try:
-        reviews = db.query(HumanReviewQueueModel).filter(
-            HumanReviewQueueModel.status == "PENDING"
+    with _session_scope(db) as db:
+        # Select only the listed columns; rows come back as tuples, not ORM objects.
+        # The checkpoint join drops items already decided, still in one SELECT.
+        # The whole listing is fetched in one go rather than streamed in chunks.
+        rows = db.execute(
+            select(
+                HumanReviewQueueModel.checkpoint_id,
+                HumanReviewQueueModel.invoice_id,
+                HumanReviewQueueModel.vendor_name,
+                HumanReviewQueueModel.amount,
+                HumanReviewQueueModel.created_at,
+                HumanReviewQueueModel.reason_for_hold,
+                HumanReviewQueueModel.review_url,
+            ).join(
+                CheckpointModel,
+                CheckpointModel.checkpoint_id == HumanReviewQueueModel.checkpoint_id,
+            ).where(
+                HumanReviewQueueModel.status == "PENDING",
+                CheckpointModel.status == "PENDING",
+            ).order_by(
+                HumanReviewQueueModel.created_at
+            )
         ).all()
         return [
             {
-                "checkpoint_id": review.checkpoint_id,
-                "invoice_id": review.invoice_id,
-                "vendor_name": review.vendor_name,
-                "amount": review.amount,
-                "created_at": review.created_at.isoformat(),
-                "reason_for_hold": review.reason_for_hold,
-                "review_url": review.review_url,
+                "checkpoint_id": row.checkpoint_id,
+                "invoice_id": row.invoice_id,
+                "vendor_name": row.vendor_name,
+                "amount": row.amount,
+                "created_at": row.created_at.isoformat(),
+                "reason_for_hold": row.reason_for_hold,
+                "review_url": row.review_url,
             }
-            for review in reviews
+            for row in rows
         ]
-    finally:
-        db.close()
 
 
-def add_to_review_queue(queue_data: dict) -> str:
+def add_to_review_queue(queue_data: dict, db: Optional[Session] = None) -> str:
     """Add item to human review queue"""
-    db = SessionLocal()
-    try:
-        review_item = HumanReviewQueueModel(
-            id=queue_data["id"],
-            checkpoint_id=queue_data["checkpoint_id"],
-            invoice_id=queue_data["invoice_id"],
-            vendor_name=queue_data["vendor_name"],
-            amount=queue_data["amount"],
-            currency=queue_data["currency"],
-            reason_for_hold=queue_data["reason_for_hold"],
-            review_url=queue_data["review_url"],
-        )
-        db.add(review_item)
+    with _session_scope(db) as db:
+        db.add(_review_queue_row(queue_data))
         db.commit()
-        db.refresh(review_item)
-        return review_item.id
-    finally:
-        db.close()
+        return queue_data["id"]
+
+
+def save_checkpoint_with_queue(checkpoint_data: dict, queue_data: dict, db: Optional[Session] = None) -> str:
+    """Save a checkpoint and its review-queue item in one transaction"""
+    with _session_scope(db) as db:
+        db.add_all([_checkpoint_row(checkpoint_data), _review_queue_row(queue_data)])
+        db.commit()
+        return checkpoint_data["checkpoint_id"]
 
 
-def log_audit(audit_data: dict):
+def log_audit(audit_data: dict, db: Optional[Session] = None):
     """Log audit entry"""
-    db = SessionLocal()
-    try:
+    with _session_scope(db) as db:
         log_entry = AuditLogModel(
             id=audit_data["id"],
             workflow_id=audit_data["workflow_id"],
@@ -207,5 +419,140 @@ def log_audit(audit_data: dict):
         )
         db.add(log_entry)
         db.commit()
-    finally:
-        db.close()
+
+
+def log_audit_batch(audit_entries: List[dict], db: Optional[Session] = None):
+    """Log several audit entries in a single transaction"""
+    if not audit_entries:
+        return
+    with _session_scope(db) as db:
+        # Core executemany insert: no ORM objects or unit-of-work bookkeeping
+        db.execute(insert(AuditLogModel), [
+            {
+                "id": audit_data["id"],
+                "workflow_id": audit_data["workflow_id"],
+                "invoice_id": audit_data["invoice_id"],
+                "timestamp": audit_data["timestamp"],
+                "stage": audit_data["stage"],
+                "action": audit_data["action"],
+                "details": audit_data["details"],
+            }
+            for audit_data in audit_entries
+        ])
+        db.commit()
+
+
+class _AuditSubmission:
+    """One submit() call: set once all of its rows are processed, with any write error"""
+    __slots__ = ("done", "error")
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class AuditWriter:
+    """
+    Persists audit rows from a background thread, coalescing rows from every
+    workflow into one executemany per batch. A batch closes at max_batch
+    rows or flush_interval seconds after its first row; once a caller is
+    waiting on a row in it, it closes with whatever is already queued, so
+    concurrent waiters share a commit instead of each paying for one.
+    
+    If a merged batch fails, its rows are retried one submit() at a time so
+    one bad row only loses the rows submitted with it. A waiting submit()
+    re-raises its own write error.
+    """
+    
+    def __init__(self, flush_interval: float = 0.1, max_batch: int = 32):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Tuple[dict, _AuditSubmission, bool, bool]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+    
+    def submit(self, audit_entries: List[dict], wait: bool = False) -> None:
+        """Queue rows for log_audit_batch(); with wait, return once they are written"""
+        if not audit_entries:
+            return
+        self._ensure_started()
+        submission = _AuditSubmission()
+        last = len(audit_entries) - 1
+        for i, audit_data in enumerate(audit_entries):
+            # (row, its submit, last row of the submit, a caller waits on it)
+            self._queue.put((audit_data, submission, i == last, wait and i == last))
+        if wait:
+            submission.done.wait()
+            if submission.error is not None:
+                raise submission.error
+    
+    def flush(self) -> None:
+        """Block until every queued row has been written"""
+        if self._thread is not None:
+            self._queue.join()
+    
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                thread.start()
+                self._thread = thread
+    
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            waited_on = batch[0][3]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    if waited_on:
+                        item = self._queue.get_nowait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                waited_on = waited_on or item[3]
+            try:
+                self._write(batch)
+            finally:
+                for _, submission, last, _ in batch:
+                    if last:
+                        submission.done.set()
+                    self._queue.task_done()
+    
+    def _write(self, batch: list) -> None:
+        """Write a batch, falling back to one transaction per submit if it fails"""
+        try:
+            log_audit_batch([audit_data for audit_data, _, _, _ in batch])
+            return
+        except Exception as e:
+            merged_error = e
+        by_submission = {}
+        for audit_data, submission, _, _ in batch:
+            by_submission.setdefault(submission, []).append(audit_data)
+        if len(by_submission) == 1:
+            (submission, rows), = by_submission.items()
+            self._fail(submission, rows, merged_error)
+            return
+        for submission, rows in by_submission.items():
+            try:
+                log_audit_batch(rows)
+            except Exception as e:
+                self._fail(submission, rows, e)
+    
+    @staticmethod
+    def _fail(submission: _AuditSubmission, rows: List[dict], error: Exception) -> None:
+        logger.error("Failed to persist %d audit rows", len(rows), exc_info=error)
+        if submission.error is None:
+            submission.error = error
+
+
+# Global audit writer; drained at interpreter exit so no rows are lost
+audit_writer = AuditWriter()
+atexit.register(audit_writer.flush)
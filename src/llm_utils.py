@@ -3,13 +3,346 @@ LLM utilities for Gemini 2.5 Flash integration
 """
 import json
 import logging
-from typing import Any, Dict
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import orjson
+import xxhash
+from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
+from pydantic import BaseModel
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from src.config import settings
+from src.cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
+class ExtractedInvoiceFields(BaseModel):
+    """Structured fields extracted from invoice text"""
+    vendor_name: Optional[str] = None
+    invoice_date: Optional[str] = None
+    due_date: Optional[str] = None
+    total_amount: Optional[float] = None
+    currency: Optional[str] = None
+    po_references: List[str] = []
+
+
+class InvoiceAnalysis(BaseModel):
+    """Combined structured output for the front-of-pipeline LLM work"""
+    extracted: ExtractedInvoiceFields
+    normalized_vendor: str
+
+
+# Prompt templates are built once at import. The instructions form a static
+# prefix and only the trailing data varies, so Gemini's implicit prompt
+# caching can reuse the prefix across invoices.
+ANALYSIS_PROMPT = ChatPromptTemplate.from_template(
+    """Analyze the following invoice and return:
+- extracted: vendor_name, invoice_date, due_date, total_amount, currency,
+  and po_references (any PO numbers found)
+- normalized_vendor: the vendor name normalized to a standard format
+  (extra spaces removed, capitalization standardized, special characters
+  removed where appropriate)
+
+Invoice text:
+{invoice_text}
+
+Vendor name: {vendor_name}"""
+)
+
+NORMALIZE_VENDOR_PROMPT = ChatPromptTemplate.from_template(
+    """Normalize the following vendor name to a standard format.
+Remove extra spaces, standardize capitalization, and remove special characters where appropriate.
+Return ONLY the normalized name, no additional text.
+
+Vendor name: {vendor_name}"""
+)
+
+MATCH_SCORE_PROMPT = ChatPromptTemplate.from_template(
+    """Compare the following invoice and Purchase Order data.
+Return a match score between 0 and 1 based on:
+- Vendor name match
+- Amount match (within tolerance)
+- Line items match
+- PO reference match
+Return ONLY a number between 0 and 1, no additional text.
+
+Invoice data:
+{invoice_data}
+
+PO data:
+{po_data}"""
+)
+
+ACCOUNTING_ENTRIES_PROMPT = ChatPromptTemplate.from_template(
+    """Generate accounting entries for the following invoice.
+Return a JSON object with:
+- entries: array of accounting entries with account_code, debit, credit, description
+- total_debits: sum of debits
+- total_credits: sum of credits
+Return ONLY valid JSON, no additional text.
+
+Invoice data:
+{invoice_data}"""
+)
+ACCOUNTING_ENTRIES_BATCH_PROMPT = ChatPromptTemplate.from_template(
+    """Generate accounting entries for each of the following {count} invoices.
+Return a JSON object with:
+- results: array with exactly one element per invoice, in the same order, each with:
+  - entries: array of accounting entries with account_code, debit, credit, description
+  - total_debits: sum of debits
+  - total_credits: sum of credits
+Return ONLY valid JSON, no additional text.
+
+Invoices:
+{invoices}"""
+)
+# Bump when ACCOUNTING_ENTRIES_PROMPT changes so cached entries are not reused
+ACCOUNTING_PROMPT_VERSION = "1"
+
+# Generated accounting entries, stored as orjson bytes by invoice fingerprint
+accounting_cache = TTLCache(
+    default_ttl=settings.ACCOUNTING_CACHE_TTL,
+    max_entries=settings.ACCOUNTING_CACHE_MAX_ENTRIES,
+)
+
+
+def accounting_cache_key(invoice_data: Dict[str, Any]) -> str:
+    """
+    Fingerprint of the invoice fields that determine its accounting entries.
+    It only keys the in-process cache, so a fast non-cryptographic hash will do.
+    """
+    canonical = json.dumps(
+        {
+            "vendor": invoice_data.get("vendor"),
+            "amount": invoice_data.get("amount"),
+            "currency": invoice_data.get("currency"),
+            "items": sorted(
+                json.dumps(item, sort_keys=True) for item in invoice_data.get("line_items", [])
+            ),
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return xxhash.xxh3_128_hexdigest(f"{ACCOUNTING_PROMPT_VERSION}:{canonical}".encode())
+
+
+# Error-text markers of a rate or quota rejection when no status code is exposed
+_RATE_LIMIT_MARKERS = ("quota", "rate limit", "resource_exhausted", "too many requests")
+# Server-side statuses worth another attempt: internal error, bad gateway,
+# unavailable, gateway timeout
+_TRANSIENT_STATUS_CODES = frozenset((500, 502, 503, 504))
+_TRANSIENT_MARKERS = (
+    "unavailable", "deadline exceeded", "deadline_exceeded",
+    "timed out", "timeout", "internal server error", "bad gateway",
+)
+
+
+class TransientLLMError(Exception):
+    """The provider failed a call in a way a later attempt may not"""
+
+
+class RateLimitError(TransientLLMError):
+    """The provider rejected a call for rate or quota reasons (HTTP 429)"""
+
+
+def _status_code(e: BaseException) -> Optional[int]:
+    for attr in ("status_code", "code"):
+        code = getattr(e, attr, None)
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def is_rate_limit_error(e: BaseException) -> bool:
+    """Whether an SDK exception, or one it wraps, is a 429 / quota rejection"""
+    while e is not None:
+        if _status_code(e) == 429:
+            return True
+        text = str(e).lower()
+        if any(marker in text for marker in _RATE_LIMIT_MARKERS):
+            return True
+        e = e.__cause__
+    return False
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """Whether an SDK exception, or one it wraps, is a 5xx, unavailable or timeout error"""
+    while e is not None:
+        if isinstance(e, (TimeoutError, ConnectionError)):
+            return True
+        if _status_code(e) in _TRANSIENT_STATUS_CODES:
+            return True
+        text = str(e).lower()
+        if any(marker in text for marker in _TRANSIENT_MARKERS):
+            return True
+        e = e.__cause__
+    return False
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `rate` tokens per second, bursts up to `capacity`.
+    clock and sleep default to time.monotonic and time.sleep; tests pass fakes.
+    """
+    
+    def __init__(
+        self,
+        rate: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a token is available, then take it"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            self._sleep(wait)
+
+
+class LLMRateLimiter:
+    """
+    Bounds Gemini calls to max_inflight at once and rps per second, and
+    retries 429 / quota rejections and transient 5xx, unavailable and
+    timeout errors with exponential backoff. Other errors are raised at
+    once for the caller's fallback to handle.
+    """
+    
+    def __init__(self, max_inflight: int, rps: float, max_attempts: int = 3, min_backoff: float = 0.5):
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        self._bucket = TokenBucket(rps)
+        self.call = retry(
+            retry=retry_if_exception_type(TransientLLMError),
+            wait=wait_exponential(multiplier=min_backoff, min=min_backoff, max=8),
+            stop=stop_after_attempt(max_attempts),
+            reraise=True,
+        )(self._call_once)
+    
+    def _call_once(self, fn: Callable[..., Any], *args: Any) -> Any:
+        # Backoff sleeps happen between attempts, outside the semaphore
+        self._bucket.acquire()
+        with self._inflight:
+            try:
+                return fn(*args)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    raise RateLimitError(str(e)) from e
+                if is_transient_error(e):
+                    raise TransientLLMError(str(e)) from e
+                raise
+
+
+class AccountingBatcher:
+    """
+    Coalesces concurrent accounting-entry requests. A collector thread takes
+    up to max_batch queued invoices and hands them to generate_many as one
+    LLM call; a lone invoice goes through generate_one with the
+    single-invoice prompt. While no call is in flight a request is sent at
+    once with whatever is already queued; only while one is in flight does
+    the collector wait up to max_wait seconds for the batch to fill.
+    """
+    
+    def __init__(
+        self,
+        generate_one: Callable[[Dict[str, Any]], Dict[str, Any]],
+        generate_many: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+        max_batch: int = 8,
+        max_wait: float = 0.05,
+        max_concurrent_batches: int = 4,
+    ):
+        self._generate_one = generate_one
+        self._generate_many = generate_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Tuple[Dict[str, Any], Future]]" = queue.Queue()
+        # Batches are dispatched to a pool so one slow call doesn't hold up the next
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_batches, thread_name_prefix="accounting-batch"
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+    
+    def submit(self, invoice_data: Dict[str, Any]) -> Future:
+        """Queue one invoice; the future resolves to its accounting entries"""
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((invoice_data, future))
+        return future
+    
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="accounting-batcher", daemon=True)
+                thread.start()
+                self._thread = thread
+    
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            with self._in_flight_lock:
+                # Idle: waiting for company would only add latency
+                wait = self.max_wait if self._in_flight else 0.0
+            deadline = time.monotonic() + wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._in_flight_lock:
+                self._in_flight += 1
+            self._executor.submit(self._dispatch, batch)
+    
+    def _dispatch(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        try:
+            self._generate(batch)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+    
+    def _generate(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        invoices = [invoice_data for invoice_data, _ in batch]
+        try:
+            if len(invoices) == 1:
+                results = [self._generate_one(invoices[0])]
+            else:
+                results = self._generate_many(invoices)
+            if len(results) != len(batch):
+                raise ValueError(f"Expected {len(batch)} results, got {len(results)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
 class GeminiLLM:
     """Wrapper for Gemini 2.5 Flash LLM"""
     
@@ -19,97 +352,165 @@ class GeminiLLM:
             google_api_key=settings.GEMINI_API_KEY,
             temperature=0.3,
             max_tokens=2048,
+            max_retries=0,  # Retries are owned by _limiter
+        )
+        self._analysis_chain = ANALYSIS_PROMPT | self.llm.with_structured_output(InvoiceAnalysis)
+        self._normalize_chain = NORMALIZE_VENDOR_PROMPT | self.llm | StrOutputParser()
+        self._match_score_chain = MATCH_SCORE_PROMPT | self.llm | StrOutputParser()
+        self._accounting_chain = ACCOUNTING_ENTRIES_PROMPT | self.llm | JsonOutputParser()
+        self._limiter = LLMRateLimiter(
+            settings.GEMINI_MAX_INFLIGHT, settings.GEMINI_RPS, settings.GEMINI_MAX_ATTEMPTS
         )
-    
-    def extract_invoice_text(self, invoice_text: str) -> Dict[str, Any]:
-        """Extract structured data from invoice text using LLM"""
-        prompt = f"""
-        Analyze the following invoice text and extract structured information.
-        Return a JSON object with:
-        - vendor_name: extracted vendor name
-        - invoice_date: extracted invoice date
-        - due_date: extracted due date
-        - total_amount: extracted total amount
-        - currency: currency code
-        - line_items: list of line items with desc, qty, unit_price, total
-        - po_references: any PO numbers found
-        
-        Invoice text:
-        {invoice_text}
         
-        Return ONLY valid JSON, no additional text.
-        """
+        # One response carries a whole batch, so it gets a proportionally larger budget
+        batch_llm = ChatGoogleGenerativeAI(
+            model=settings.GEMINI_MODEL,
+            google_api_key=settings.GEMINI_API_KEY,
+            temperature=0.3,
+            max_tokens=2048 * settings.ACCOUNTING_BATCH_SIZE,
+            max_retries=0,
+        )
+        self._accounting_batch_chain = ACCOUNTING_ENTRIES_BATCH_PROMPT | batch_llm | JsonOutputParser()
+        self._accounting_inflight: Dict[str, Future] = {}
+        self._accounting_inflight_lock = threading.Lock()
+        self._accounting_batcher = AccountingBatcher(
+            self._invoke_accounting,
+            self._invoke_accounting_batch,
+            max_batch=settings.ACCOUNTING_BATCH_SIZE,
+            max_wait=settings.ACCOUNTING_BATCH_MAX_WAIT,
+        )
+    
+    def process_invoice_all(self, invoice_text: str, vendor_name: str) -> Dict[str, Any]:
+        """Extract invoice fields and normalize the vendor name in one LLM call"""
         try:
-            response = self.llm.invoke(prompt)
-            result = json.loads(response.content)
-            return result
+            analysis = self._limiter.call(
+                self._analysis_chain.invoke,
+                {"invoice_text": invoice_text, "vendor_name": vendor_name},
+            )
+            return {
+                "extracted": analysis.extracted.model_dump(),
+                "normalized_vendor": analysis.normalized_vendor.strip() or vendor_name,
+            }
         except Exception as e:
-            logger.error(f"Error extracting invoice text: {e}")
-            return {}
+            logger.error("Error analyzing invoice: %s", e)
+            return {"extracted": {}, "normalized_vendor": vendor_name}
     
     def normalize_vendor_name(self, vendor_name: str) -> str:
         """Normalize vendor name using LLM"""
-        prompt = f"""
-        Normalize the following vendor name to a standard format.
-        Remove extra spaces, standardize capitalization, and remove special characters where appropriate.
-        Return ONLY the normalized name, no additional text.
-        
-        Vendor name: {vendor_name}
-        """
         try:
-            response = self.llm.invoke(prompt)
-            return response.content.strip()
+            return self._limiter.call(self._normalize_chain.invoke, {"vendor_name": vendor_name}).strip()
         except Exception as e:
-            logger.error(f"Error normalizing vendor name: {e}")
+            logger.error("Error normalizing vendor name: %s", e)
             return vendor_name
     
-    def compute_match_score(self, invoice_data: Dict[str, Any], po_data: Dict[str, Any]) -> float:
-        """Compute match score between invoice and PO using LLM"""
-        prompt = f"""
-        Compare the following invoice and Purchase Order data.
-        Return a match score between 0 and 1 based on:
-        - Vendor name match
-        - Amount match (within tolerance)
-        - Line items match
-        - PO reference match
-        
-        Invoice data:
-        {json.dumps(invoice_data, indent=2)}
+    @staticmethod
+    def _line_item_keys(items: List[Dict[str, Any]]) -> List[Tuple[str, float]]:
+        return sorted((str(item.get("desc", "")).strip().lower(), float(item.get("qty") or 0)) for item in items)
+    
+    @staticmethod
+    def _deterministic_match_score(invoice_data: Dict[str, Any], po_data: Dict[str, Any]) -> Optional[float]:
+        """
+        Score clear-cut pairs without the LLM; None means the pair is ambiguous.
+        A PO's vendor_id is the vendor's tax id (the PO index blocks on it), so
+        it is compared with the invoice's vendor_tax_id. A pair scores 1.0 only
+        when vendor, amount and line items (description and quantity) all
+        agree, and 0.0 when neither vendor nor amount does.
+        """
+        invoice_amount = invoice_data.get("amount", 0.0)
+        po_amount = po_data.get("amount", 0.0)
+        largest = max(abs(invoice_amount), abs(po_amount))
+        amount_close = (
+            largest == 0
+            or abs(invoice_amount - po_amount) / largest <= settings.TWO_WAY_TOLERANCE_PCT / 100
+        )
+        invoice_vendor = str(invoice_data.get("vendor_tax_id", "")).strip().upper()
+        po_vendor = str(po_data.get("vendor_id", "")).strip().upper()
+        vendor_match = bool(invoice_vendor) and invoice_vendor == po_vendor
         
-        PO data:
-        {json.dumps(po_data, indent=2)}
+        if not amount_close and not vendor_match:
+            return 0.0
+        if amount_close and vendor_match:
+            po_items = po_data.get("items") or []
+            invoice_items = invoice_data.get("line_items") or []
+            if po_items and GeminiLLM._line_item_keys(invoice_items) == GeminiLLM._line_item_keys(po_items):
+                return 1.0
+        return None
+    
+    def compute_match_score(self, invoice_data: Dict[str, Any], po_data: Dict[str, Any]) -> float:
+        """Compute match score between invoice and PO, using the LLM only for ambiguous pairs"""
+        score = self._deterministic_match_score(invoice_data, po_data)
+        if score is not None:
+            return score
         
-        Return ONLY a number between 0 and 1, no additional text.
-        """
         try:
-            response = self.llm.invoke(prompt)
-            score = float(response.content.strip())
+            response = self._limiter.call(self._match_score_chain.invoke, {
+                "invoice_data": json.dumps(invoice_data, indent=2),
+                "po_data": json.dumps(po_data, indent=2),
+            })
+            score = float(response.strip())
             return max(0.0, min(1.0, score))
         except Exception as e:
-            logger.error(f"Error computing match score: {e}")
+            logger.error("Error computing match score: %s", e)
             return 0.0
     
     def generate_accounting_entries(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
         """Generate accounting entries from invoice using LLM"""
-        prompt = f"""
-        Generate accounting entries for the following invoice.
-        Return a JSON object with:
-        - entries: array of accounting entries with account_code, debit, credit, description
-        - total_debits: sum of debits
-        - total_credits: sum of credits
+        key = accounting_cache_key(invoice_data)
+        cached = accounting_cache.get(key)
+        if cached is not None:
+            return orjson.loads(cached)
         
-        Invoice data:
-        {json.dumps(invoice_data, indent=2)}
+        # Single flight: identical invoices in flight at once share one request.
+        # The first caller makes it; the rest wait on its future for the bytes.
+        # A leader fills the cache before leaving the table, so checking the
+        # cache again under the lock catches one that finished since the first look.
+        with self._accounting_inflight_lock:
+            inflight = self._accounting_inflight.get(key)
+            if inflight is None:
+                cached = accounting_cache.get(key)
+                if cached is None:
+                    self._accounting_inflight[key] = leader = Future()
+        if cached is not None:
+            return orjson.loads(cached)
+        if inflight is not None:
+            try:
+                return orjson.loads(inflight.result())
+            except Exception:
+                return {"entries": [], "total_debits": 0.0, "total_credits": 0.0}
         
-        Return ONLY valid JSON, no additional text.
-        """
         try:
-            response = self.llm.invoke(prompt)
-            result = json.loads(response.content)
-            return result
+            # Concurrent workflows share one LLM call through the batcher
+            result = self._accounting_batcher.submit(invoice_data).result()
+            encoded = orjson.dumps(result)
         except Exception as e:
-            logger.error(f"Error generating accounting entries: {e}")
+            logger.error("Error generating accounting entries: %s", e)
+            with self._accounting_inflight_lock:
+                del self._accounting_inflight[key]
+            leader.set_exception(e)
             return {"entries": [], "total_debits": 0.0, "total_credits": 0.0}
+        # Failures above are not cached, so the next identical invoice retries.
+        accounting_cache.set(key, encoded)
+        with self._accounting_inflight_lock:
+            del self._accounting_inflight[key]
+        leader.set_result(encoded)
+        return result
+    
+    def _invoke_accounting(self, invoice_data: Dict[str, Any]) -> Dict[str, Any]:
+        return self._limiter.call(self._accounting_chain.invoke, {
+            "invoice_data": json.dumps(invoice_data, indent=2),
+        })
+    
+    def _invoke_accounting_batch(self, invoices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        response = self._limiter.call(self._accounting_batch_chain.invoke, {
+            "count": len(invoices),
+            "invoices": json.dumps(invoices, indent=2),
+        })
+        results = response.get("results") if isinstance(response, dict) else None
+        if not isinstance(results, list) or len(results) != len(invoices):
+            # Can't tell which result belongs to which invoice; ask one at a time
+            logger.warning("Batched accounting response did not match %d invoices", len(invoices))
+            return [self._invoke_accounting(invoice_data) for invoice_data in invoices]
+        return results
     
     def determine_approval_status(self, invoice_amount: float, approval_threshold: float) -> str:
         """Determine approval status based on amount and rules"""
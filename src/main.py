@@ -3,39 +3,66 @@ FastAPI application for Invoice Processing Workflow with HITL
 """
 import logging
 import json
-from typing import List
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from src.config import settings
+from typing import Any, List
+import orjson
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+from src.config import configure_logging, settings
 from src.schemas import (
     InvoicePayload, HumanReviewListResponse, HumanReviewItem,
     HumanReviewDecisionRequest, HumanReviewDecisionResponse,
-    WorkflowState, CompleteOutput
+    WorkflowState, CompleteOutput, HITL_NEXT_STAGE
 )
 from src.workflow import create_workflow_state, invoice_processing_workflow
-from src.database import get_pending_reviews, get_checkpoint, update_checkpoint_decision
+from src.database import get_db, get_pending_reviews, get_checkpoint, update_checkpoint_decision
+from src.cache import (
+    PENDING_REVIEWS_KEY, response_cache, invalidate_pending_reviews,
+    pending_reviews_generation, cache_pending_reviews
+)
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+configure_logging()
 logger = logging.getLogger(__name__)
 
+
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered with orjson (native datetime/UUID/enum support)"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+
+def _model_response(model: BaseModel) -> Response:
+    """
+    Serialize a response model the handler just built. FastAPI would
+    otherwise dump and re-validate it against the route's response_model,
+    which stays on the route for the OpenAPI schema only.
+    """
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
 # Create FastAPI app
 app = FastAPI(
     title="Invoice Processing Agent with HITL",
     description="LangGraph-based invoice processing with Human-In-The-Loop checkpoints",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
 
 # ============================================================================
 # Workflow Execution Endpoints
 # ============================================================================
+# Handlers that call the blocking workflow or database helpers are plain
+# `def`, so FastAPI runs them in its threadpool instead of on the event loop.
 
 @app.post("/process-invoice")
-async def process_invoice(invoice_payload: InvoicePayload) -> dict:
+def process_invoice(invoice_payload: InvoicePayload) -> ORJSONResponse:
     """
     Process an invoice through the complete workflow.
     
@@ -43,7 +70,10 @@ async def process_invoice(invoice_payload: InvoicePayload) -> dict:
     - If match succeeds: Final payload with all processing results
     - If match fails: Checkpoint info with review URL
     """
-    logger.info(f"Processing invoice: {invoice_payload.invoice_id}")
+    logger.info(
+        "Processing invoice: %s", invoice_payload.invoice_id,
+        extra={"invoice_id": invoice_payload.invoice_id},
+    )
     
     try:
         # Create initial workflow state
@@ -51,35 +81,48 @@ async def process_invoice(invoice_payload: InvoicePayload) -> dict:
         
         # Execute workflow
         final_state = invoice_processing_workflow.invoke(state)
+        if isinstance(final_state, dict):
+            final_state = WorkflowState.model_construct(**final_state)
         
         # Check if workflow completed or paused at HITL
+        # Bodies are built from JSON-ready values, so they are rendered as-is
+        # rather than walked again by FastAPI's response serialization
         if final_state.checkpoint_hitl_output:
-            return {
+            return ORJSONResponse({
                 "status": "PAUSED_FOR_REVIEW",
                 "checkpoint_id": final_state.checkpoint_hitl_output.checkpoint_id,
                 "review_url": final_state.checkpoint_hitl_output.review_url,
                 "reason": final_state.checkpoint_hitl_output.paused_reason,
                 "workflow_id": final_state.workflow_id,
-            }
+            })
         
         # Return final payload
         if final_state.complete_output:
-            return {
+            # Single serializer walk; the result is already JSON-ready primitives
+            dumped = final_state.model_dump(
+                mode="json",
+                include={
+                    "workflow_id": True,
+                    "tool_selections": True,
+                    "complete_output": {"final_payload", "audit_log"},
+                },
+            )
+            return ORJSONResponse({
                 "status": "COMPLETED",
-                "workflow_id": final_state.workflow_id,
-                "final_payload": final_state.complete_output.final_payload.model_dump(),
-                "audit_log": [log.model_dump() for log in final_state.complete_output.audit_log],
-                "tool_selections": final_state.tool_selections,
-            }
+                "workflow_id": dumped["workflow_id"],
+                "final_payload": dumped["complete_output"]["final_payload"],
+                "audit_log": dumped["complete_output"]["audit_log"],
+                "tool_selections": dumped["tool_selections"],
+            })
         
-        return {
+        return ORJSONResponse({
             "status": "COMPLETED",
             "workflow_id": final_state.workflow_id,
             "message": "Workflow executed successfully",
-        }
+        })
     
     except Exception as e:
-        logger.error(f"Error processing invoice: {e}", exc_info=True)
+        logger.error("Error processing invoice: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -87,8 +130,13 @@ async def process_invoice(invoice_payload: InvoicePayload) -> dict:
 # Human Review Endpoints
 # ============================================================================
 
+# The listing cache and its invalidation live in one process: with several
+# workers a decision would only clear the copy in the worker that took it,
+# so the listing is cached only when the API runs on a single worker.
+CACHE_PENDING_REVIEWS = settings.api_worker_count == 1
+
 @app.get("/human-review/pending", response_model=HumanReviewListResponse)
-async def list_pending_reviews() -> HumanReviewListResponse:
+def list_pending_reviews(db: Session = Depends(get_db)) -> Response:
     """
     List all pending human reviews.
     
@@ -98,7 +146,13 @@ async def list_pending_reviews() -> HumanReviewListResponse:
     logger.info("Fetching pending reviews")
     
     try:
-        pending_items = get_pending_reviews()
+        if CACHE_PENDING_REVIEWS:
+            cached = response_cache.get(PENDING_REVIEWS_KEY)
+            if cached is not None:
+                return Response(content=cached, media_type="application/json")
+        
+        generation = pending_reviews_generation()
+        pending_items = get_pending_reviews(db)
         items = [
             HumanReviewItem(
                 checkpoint_id=item["checkpoint_id"],
@@ -111,15 +165,19 @@ async def list_pending_reviews() -> HumanReviewListResponse:
             )
             for item in pending_items
         ]
-        return HumanReviewListResponse(items=items)
+        body = HumanReviewListResponse(items=items).model_dump_json()
+        if CACHE_PENDING_REVIEWS:
+            # Skipped if a decision or new checkpoint landed during the read
+            cache_pending_reviews(body, generation, settings.PENDING_REVIEWS_CACHE_TTL)
+        return Response(content=body, media_type="application/json")
     
     except Exception as e:
-        logger.error(f"Error fetching pending reviews: {e}", exc_info=True)
+        logger.error("Error fetching pending reviews: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/human-review/{checkpoint_id}")
-async def get_review_details(checkpoint_id: str) -> dict:
+def get_review_details(checkpoint_id: str, db: Session = Depends(get_db)) -> Response:
     """
     Get detailed information about a specific checkpoint for review.
     
@@ -129,24 +187,30 @@ async def get_review_details(checkpoint_id: str) -> dict:
     Returns:
     - Checkpoint details including state blob for review
     """
-    logger.info(f"Fetching review details for checkpoint: {checkpoint_id}")
+    logger.info(
+        "Fetching review details for checkpoint: %s", checkpoint_id,
+        extra={"checkpoint_id": checkpoint_id},
+    )
     
     try:
-        checkpoint = get_checkpoint(checkpoint_id)
+        checkpoint = get_checkpoint(checkpoint_id, db)
         if not checkpoint:
             raise HTTPException(status_code=404, detail="Checkpoint not found")
         
-        return checkpoint
+        # Encoded directly; a dict return would be walked by jsonable_encoder first
+        return Response(content=orjson.dumps(checkpoint), media_type="application/json")
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error fetching checkpoint: {e}", exc_info=True)
+        logger.error("Error fetching checkpoint: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/human-review/decision", response_model=HumanReviewDecisionResponse)
-async def submit_human_decision(request: HumanReviewDecisionRequest) -> HumanReviewDecisionResponse:
+def submit_human_decision(
+    request: HumanReviewDecisionRequest, db: Session = Depends(get_db)
+) -> Response:
     """
     Submit human decision (ACCEPT/REJECT) for a checkpoint.
     
@@ -159,11 +223,14 @@ async def submit_human_decision(request: HumanReviewDecisionRequest) -> HumanRev
     Returns:
     - Resume token and next stage for workflow continuation
     """
-    logger.info(f"Submitting decision for checkpoint: {request.checkpoint_id}")
+    logger.info(
+        "Submitting decision for checkpoint: %s", request.checkpoint_id,
+        extra={"checkpoint_id": request.checkpoint_id},
+    )
     
     try:
         # Validate checkpoint exists
-        checkpoint = get_checkpoint(request.checkpoint_id)
+        checkpoint = get_checkpoint(request.checkpoint_id, db, include_state_blob=False)
         if not checkpoint:
             raise HTTPException(status_code=404, detail="Checkpoint not found")
         
@@ -173,22 +240,31 @@ async def submit_human_decision(request: HumanReviewDecisionRequest) -> HumanRev
             request.decision.value,
             request.reviewer_id,
             request.notes,
+            db,
         )
+        invalidate_pending_reviews()
         
-        logger.info(f"Decision recorded: {request.decision.value} by {request.reviewer_id}")
+        logger.info(
+            "Decision recorded: %s by %s", request.decision.value, request.reviewer_id,
+            extra={
+                "checkpoint_id": request.checkpoint_id,
+                "decision": request.decision.value,
+                "reviewer_id": request.reviewer_id,
+            },
+        )
         
         # Determine next stage based on decision
-        next_stage = "RECONCILE" if request.decision.value == "ACCEPT" else "COMPLETE"
+        next_stage = HITL_NEXT_STAGE[request.decision]
         
-        return HumanReviewDecisionResponse(
+        return _model_response(HumanReviewDecisionResponse(
             resume_token=f"token-{request.checkpoint_id}",
             next_stage=next_stage,
-        )
+        ))
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error submitting decision: {e}", exc_info=True)
+        logger.error("Error submitting decision: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -206,52 +282,63 @@ async def health_check() -> dict:
     }
 
 
+# Static for the life of the process, so serialized once at import
+_CONFIG_BODY = orjson.dumps({
+    "match_threshold": settings.MATCH_THRESHOLD,
+    "two_way_tolerance_pct": settings.TWO_WAY_TOLERANCE_PCT,
+    "auto_approve_threshold": settings.AUTO_APPROVE_THRESHOLD,
+    "gemini_model": settings.GEMINI_MODEL,
+    "database_url": settings.DATABASE_URL,
+    "bigtool_pools": {
+        "ocr": settings.OCR_TOOLS,
+        "enrichment": settings.ENRICHMENT_TOOLS,
+        "erp": settings.ERP_TOOLS,
+        "db": settings.DB_TOOLS,
+        "email": settings.EMAIL_TOOLS,
+    },
+})
+
+
 @app.get("/config")
-async def get_config() -> dict:
+async def get_config() -> Response:
     """Get workflow configuration"""
-    return {
-        "match_threshold": settings.MATCH_THRESHOLD,
-        "two_way_tolerance_pct": settings.TWO_WAY_TOLERANCE_PCT,
-        "auto_approve_threshold": settings.AUTO_APPROVE_THRESHOLD,
-        "gemini_model": settings.GEMINI_MODEL,
-        "database_url": settings.DATABASE_URL,
-        "bigtool_pools": {
-            "ocr": settings.OCR_TOOLS,
-            "enrichment": settings.ENRICHMENT_TOOLS,
-            "erp": settings.ERP_TOOLS,
-            "db": settings.DB_TOOLS,
-            "email": settings.EMAIL_TOOLS,
-        },
-    }
+    return Response(content=_CONFIG_BODY, media_type="application/json")
 
 
 # ============================================================================
 # Root endpoint
 # ============================================================================
 
+_ROOT_BODY = orjson.dumps({
+    "service": "Invoice Processing Agent with HITL",
+    "version": "1.0.0",
+    "endpoints": {
+        "process_invoice": "POST /process-invoice",
+        "list_pending_reviews": "GET /human-review/pending",
+        "get_review_details": "GET /human-review/{checkpoint_id}",
+        "submit_decision": "POST /human-review/decision",
+        "health": "GET /health",
+        "config": "GET /config",
+    },
+    "docs": "/docs",
+})
+
+
 @app.get("/")
-async def root() -> dict:
+async def root() -> Response:
     """Root endpoint with API documentation"""
-    return {
-        "service": "Invoice Processing Agent with HITL",
-        "version": "1.0.0",
-        "endpoints": {
-            "process_invoice": "POST /process-invoice",
-            "list_pending_reviews": "GET /human-review/pending",
-            "get_review_details": "GET /human-review/{checkpoint_id}",
-            "submit_decision": "POST /human-review/decision",
-            "health": "GET /health",
-            "config": "GET /config",
-        },
-        "docs": "/docs",
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 
 if __name__ == "__main__":
     import uvicorn
+    # uvicorn's "auto" loop/http pick uvloop and httptools when they are installed
     uvicorn.run(
-        app,
+        "src.main:app",
         host=settings.API_HOST,
         port=settings.API_PORT,
         reload=settings.API_DEBUG,
+        workers=settings.api_worker_count,
+        loop="auto",
+        http="auto",
     )
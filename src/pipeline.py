@@ -0,0 +1,124 @@
+"""
+Async stage pipeline for processing a batch of invoices
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from src.schemas import InvoicePayload, WorkflowState
+from src.workflow import (
+    create_workflow_state, route,
+    node_intake, node_understand, node_prepare, node_retrieve,
+    node_match_two_way, node_checkpoint_hitl, node_hitl_decision,
+    node_reconcile, node_approve, node_posting, node_notify, node_complete,
+)
+
+logger = logging.getLogger(__name__)
+
+# Same nodes and order as the LangGraph workflow
+STAGES: Dict[str, Callable[[WorkflowState], WorkflowState]] = {
+    "intake": node_intake,
+    "understand": node_understand,
+    "prepare": node_prepare,
+    "retrieve": node_retrieve,
+    "match_two_way": node_match_two_way,
+    "checkpoint_hitl": node_checkpoint_hitl,
+    "hitl_decision": node_hitl_decision,
+    "reconcile": node_reconcile,
+    "approve": node_approve,
+    "posting": node_posting,
+    "notify": node_notify,
+    "complete": node_complete,
+}
+
+# Fixed edges; match_two_way and hitl_decision are routed per invoice and
+# complete is the end
+NEXT_STAGE: Dict[str, Optional[str]] = {
+    "intake": "understand",
+    "understand": "prepare",
+    "prepare": "retrieve",
+    "retrieve": "match_two_way",
+    "checkpoint_hitl": "hitl_decision",
+    "reconcile": "approve",
+    "approve": "posting",
+    "posting": "notify",
+    "notify": "complete",
+    "complete": None,
+}
+
+_Item = Tuple[WorkflowState, asyncio.Future]
+
+
+def next_stage(stage: str, state: WorkflowState) -> Optional[str]:
+    """Stage an invoice moves to after `stage`, or None when it is done"""
+    if stage == "match_two_way" or stage == "hitl_decision":
+        return route(state)
+    return NEXT_STAGE[stage]
+
+
+class InvoicePipeline:
+    """
+    Runs every stage as its own worker fed by a bounded asyncio.Queue, so
+    different invoices occupy different stages at the same time (invoice A
+    posting while invoice B reconciles). Nodes are blocking, so each call is
+    made in a thread; full queues hold back upstream stages. Single invoices
+    still go through invoice_processing_workflow.
+    """
+
+    def __init__(self, queue_size: int = 8, workers_per_stage: int = 1):
+        self.queue_size = queue_size
+        self.workers_per_stage = workers_per_stage
+
+    async def _worker(
+        self, stage: str, queues: Dict[str, "asyncio.Queue[_Item]"]
+    ) -> None:
+        stage_fn = STAGES[stage]
+        in_q = queues[stage]
+        while True:
+            state, done = await in_q.get()
+            try:
+                state = await asyncio.to_thread(stage_fn, state)
+                target = next_stage(stage, state)
+            except Exception as e:
+                logger.error("[PIPELINE] Stage %s failed: %s", stage, e, exc_info=True)
+                done.set_exception(e)
+                continue
+            finally:
+                in_q.task_done()
+            if target is None:
+                done.set_result(state)
+            else:
+                await queues[target].put((state, done))
+
+    async def run(
+        self, payloads: Iterable[InvoicePayload]
+    ) -> List[Union[WorkflowState, Exception]]:
+        """
+        Process invoices through the pipeline. Outcomes are in input order:
+        the final state, or the exception that stopped that invoice, so one
+        failure does not discard the rest of the batch.
+        """
+        loop = asyncio.get_running_loop()
+        queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES}
+        workers = [
+            asyncio.create_task(self._worker(stage, queues))
+            for stage in STAGES
+            for _ in range(self.workers_per_stage)
+        ]
+        futures: List[asyncio.Future] = []
+        try:
+            for payload in payloads:
+                done = loop.create_future()
+                futures.append(done)
+                await queues["intake"].put((create_workflow_state(payload), done))
+            return list(await asyncio.gather(*futures, return_exceptions=True))
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def process_invoices(
+    payloads: Iterable[InvoicePayload], queue_size: int = 8
+) -> List[Union[WorkflowState, Exception]]:
+    """Blocking entry point for batch processing outside an event loop"""
+    return asyncio.run(InvoicePipeline(queue_size=queue_size).run(payloads))
@@ -0,0 +1,65 @@
+"""
+Blocking index over purchase orders and goods received notes
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List
+from src.schemas import PurchaseOrder, GoodsReceivedNote
+
+# Width of an amount block; neighbouring blocks are also searched so that
+# amounts straddling a block boundary still meet.
+AMOUNT_BUCKET_SIZE = 100.0
+
+
+def amount_bucket(amount: float) -> int:
+    """Block key for an amount"""
+    return round(amount / AMOUNT_BUCKET_SIZE)
+
+
+class PurchaseOrderIndex:
+    """
+    Groups POs by shared field values (blocking) so RETRIEVE only compares an
+    invoice against POs with the same vendor tax id or a similar amount,
+    instead of scanning every PO.
+    """
+
+    def __init__(self):
+        self._pos_by_vendor_tax_id: Dict[str, List[PurchaseOrder]] = defaultdict(list)
+        self._pos_by_amount_bucket: Dict[int, List[PurchaseOrder]] = defaultdict(list)
+        self._grns_by_po_id: Dict[str, List[GoodsReceivedNote]] = defaultdict(list)
+
+    def add_purchase_orders(self, pos: Iterable[PurchaseOrder]) -> None:
+        """Index POs, e.g. from an ERP sync at startup"""
+        for po in pos:
+            self._pos_by_vendor_tax_id[po.vendor_id].append(po)
+            self._pos_by_amount_bucket[amount_bucket(po.amount)].append(po)
+
+    def add_goods_received_notes(self, grns: Iterable[GoodsReceivedNote]) -> None:
+        """Index GRNs by the PO they were received against"""
+        for grn in grns:
+            self._grns_by_po_id[grn.po_id].append(grn)
+
+    def candidates(self, vendor_tax_id: str, amount: float) -> List[PurchaseOrder]:
+        """Candidate POs for an invoice: vendor block first, then amount blocks"""
+        bucket = amount_bucket(amount)
+        blocks = [
+            self._pos_by_vendor_tax_id.get(vendor_tax_id, []),
+            self._pos_by_amount_bucket.get(bucket - 1, []),
+            self._pos_by_amount_bucket.get(bucket, []),
+            self._pos_by_amount_bucket.get(bucket + 1, []),
+        ]
+        seen = set()
+        result = []
+        for block in blocks:
+            for po in block:
+                if po.po_id not in seen:
+                    seen.add(po.po_id)
+                    result.append(po)
+        return result
+
+    def grns_for(self, pos: Iterable[PurchaseOrder]) -> List[GoodsReceivedNote]:
+        """GRNs received against any of the given POs"""
+        return [grn for po in pos for grn in self._grns_by_po_id.get(po.po_id, [])]
+
+
+# Global PO index, populated by whatever loads ERP data
+po_index = PurchaseOrderIndex()
@@ -4,7 +4,8 @@ Pydantic schemas for Invoice Processing Workflow
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 from enum import Enum
-from pydantic import BaseModel, Field, validator
+from typing_extensions import NotRequired, TypedDict
+from pydantic import BaseModel, ConfigDict, Field, SkipValidation, validator
 
 
 class MatchResultEnum(str, Enum):
@@ -40,8 +41,17 @@ class WorkflowStatusEnum(str, Enum):
     FAILED = "FAILED"
 
 
+# Stage a workflow resumes at after each human decision
+HITL_NEXT_STAGE = {
+    HumanDecisionEnum.ACCEPT: WorkflowStatusEnum.RECONCILE.value,
+    HumanDecisionEnum.REJECT: WorkflowStatusEnum.COMPLETE.value,
+}
+
+
 # Input Schemas
-class LineItem(BaseModel):
+# Leaf records that only ever live inside a parent model are TypedDicts:
+# Pydantic still validates them, but without building a model per instance.
+class LineItem(TypedDict):
     desc: str
     qty: float
     unit_price: float
@@ -61,25 +71,30 @@ class InvoicePayload(BaseModel):
 
 
 # Stage Output Schemas
-class IntakeOutput(BaseModel):
+class StageModel(BaseModel):
+    """Base for stage outputs: written once by their node, then only read"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+
+class IntakeOutput(StageModel):
     raw_id: str
     ingest_ts: str
     validated: bool
 
 
-class ParsedLineItem(BaseModel):
+class ParsedLineItem(StageModel):
     desc: str
     qty: float
     unit_price: float
     total: float
 
 
-class ParsedDates(BaseModel):
+class ParsedDates(StageModel):
     invoice_date: str
     due_date: str
 
 
-class ParsedInvoice(BaseModel):
+class ParsedInvoice(StageModel):
     invoice_text: str
     parsed_line_items: List[ParsedLineItem]
     detected_pos: List[str]
@@ -87,128 +102,128 @@ class ParsedInvoice(BaseModel):
     parsed_dates: ParsedDates
 
 
-class UnderstandOutput(BaseModel):
+class UnderstandOutput(StageModel):
     parsed_invoice: ParsedInvoice
 
 
-class EnrichmentMeta(BaseModel):
+class EnrichmentMeta(StageModel):
     source: str
     confidence: float
     enriched_at: str
 
 
-class VendorProfile(BaseModel):
+class VendorProfile(StageModel):
     normalized_name: str
     tax_id: str
     enrichment_meta: Optional[EnrichmentMeta] = None
 
 
-class NormalizedInvoice(BaseModel):
+class NormalizedInvoice(StageModel):
     amount: float
     currency: str
     line_items: List[ParsedLineItem]
 
 
-class Flags(BaseModel):
-    missing_info: List[str] = []
+class Flags(TypedDict):
+    missing_info: NotRequired[List[str]]
     risk_score: float
 
 
-class PrepareOutput(BaseModel):
+class PrepareOutput(StageModel):
     vendor_profile: VendorProfile
     normalized_invoice: NormalizedInvoice
     flags: Flags
 
 
-class PurchaseOrder(BaseModel):
+class PurchaseOrder(StageModel):
     po_id: str
     vendor_id: str
     amount: float
     items: List[Dict[str, Any]]
 
 
-class GoodsReceivedNote(BaseModel):
+class GoodsReceivedNote(StageModel):
     grn_id: str
     po_id: str
     received_qty: float
     received_date: str
 
 
-class RetrieveOutput(BaseModel):
+class RetrieveOutput(StageModel):
     matched_pos: List[PurchaseOrder]
     matched_grns: List[GoodsReceivedNote]
     history: List[Dict[str, Any]]
 
 
-class MatchEvidence(BaseModel):
+class MatchEvidence(StageModel):
     amount_match: bool
     po_match: bool
     vendor_match: bool
     details: Dict[str, Any]
 
 
-class MatchTwoWayOutput(BaseModel):
+class MatchTwoWayOutput(StageModel):
     match_score: float
     match_result: MatchResultEnum
     tolerance_pct: float
     match_evidence: MatchEvidence
 
 
-class CheckpointHitlOutput(BaseModel):
+class CheckpointHitlOutput(StageModel):
     checkpoint_id: str
     review_url: str
     paused_reason: str
 
 
-class HitlDecisionOutput(BaseModel):
+class HitlDecisionOutput(StageModel):
     human_decision: HumanDecisionEnum
     reviewer_id: str
     resume_token: str
     next_stage: str
 
 
-class AccountingEntry(BaseModel):
+class AccountingEntry(StageModel):
     account_code: str
     debit: float = 0.0
     credit: float = 0.0
     description: str
 
 
-class ReconciliationReport(BaseModel):
+class ReconciliationReport(TypedDict):
     total_debits: float
     total_credits: float
     balanced: bool
     entries_count: int
 
 
-class ReconcileOutput(BaseModel):
+class ReconcileOutput(StageModel):
     accounting_entries: List[AccountingEntry]
     reconciliation_report: ReconciliationReport
 
 
-class ApproveOutput(BaseModel):
+class ApproveOutput(StageModel):
     approval_status: ApprovalStatusEnum
     approver_id: Optional[str] = None
 
 
-class PostingOutput(BaseModel):
+class PostingOutput(StageModel):
     posted: bool
     erp_txn_id: str
     scheduled_payment_id: str
 
 
-class NotifyStatus(BaseModel):
+class NotifyStatus(TypedDict):
     vendor_email: bool
     finance_team_slack: bool
     details: Dict[str, Any]
 
 
-class NotifyOutput(BaseModel):
+class NotifyOutput(StageModel):
     notify_status: NotifyStatus
     notified_parties: List[str]
 
 
-class FinalPayload(BaseModel):
+class FinalPayload(StageModel):
     invoice_id: str
     vendor_name: str
     amount: float
@@ -226,7 +241,7 @@ class AuditLogEntry(BaseModel):
     details: Dict[str, Any]
 
 
-class CompleteOutput(BaseModel):
+class CompleteOutput(StageModel):
     final_payload: FinalPayload
     audit_log: List[AuditLogEntry]
     status: WorkflowStatusEnum
@@ -234,6 +249,8 @@ class CompleteOutput(BaseModel):
 
 # Workflow State Schema
 class WorkflowState(BaseModel):
+    model_config = ConfigDict(use_enum_values=False)
+    
     # Metadata
     workflow_id: str
     current_stage: WorkflowStatusEnum
@@ -257,12 +274,13 @@ class WorkflowState(BaseModel):
     notify_output: Optional[NotifyOutput] = None
     complete_output: Optional[CompleteOutput] = None
     
-    # Execution tracking
-    execution_log: List[AuditLogEntry] = []
+    # Execution tracking. Entries are appended in place by log_stage_execution;
+    # validating the field would copy the list on every node hand-off.
+    execution_log: SkipValidation[List[AuditLogEntry]] = []
     tool_selections: Dict[str, str] = {}
     
-    class Config:
-        use_enum_values = False
+    # LLM results computed ahead of the stage that consumes them
+    llm_results: Dict[str, Any] = {}
 
 
 # Checkpoint Schema
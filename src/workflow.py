@@ -3,9 +3,14 @@ LangGraph Invoice Processing Workflow - Core Implementation
 """
 import logging
 import json
+import math
+import secrets
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import Dict, Any, Optional
+from datetime import datetime, timezone
+from operator import attrgetter
+from typing import Any, Callable, Dict, Optional
 from langgraph.graph import StateGraph, END
 from src.schemas import (
     WorkflowState, InvoicePayload, IntakeOutput, UnderstandOutput,
@@ -16,69 +21,165 @@ from src.schemas import (
     ParsedLineItem, ParsedDates, VendorProfile, EnrichmentMeta,
     NormalizedInvoice, Flags, PurchaseOrder, GoodsReceivedNote,
     MatchEvidence, AccountingEntry, ReconciliationReport, NotifyStatus,
-    FinalPayload
+    FinalPayload, HITL_NEXT_STAGE
 )
 from src.config import settings
 from src.database import (
-    save_checkpoint, get_checkpoint, update_checkpoint_decision,
-    add_to_review_queue, log_audit
+    save_checkpoint_with_queue, get_checkpoint, update_checkpoint_decision,
+    audit_writer, encode_state_blob
 )
 from src.bigtool import BigtoolPicker, common_mcp, atlas_mcp
 from src.llm_utils import gemini_llm
+from src.po_index import po_index
+from src.cache import invalidate_pending_reviews
 
 logger = logging.getLogger(__name__)
 
+# Selection depends only on settings and no node passes context, so each
+# capability is resolved once at import rather than on every invoice
+_DEFAULT_TOOLS = {
+    capability: BigtoolPicker.select(capability)
+    for capability in ("storage", "ocr", "enrichment", "erp_connector", "db", "email")
+}
+
+
+def _now_iso() -> str:
+    """Current UTC time as an ISO string with offset; one call per node"""
+    return datetime.now(timezone.utc).isoformat()
+
+
+# Random bytes for short id suffixes, drawn from the OS once per 64 KiB
+# rather than once per id; nodes run on several threads, hence the lock
+_RAND_POOL_SIZE = 65536
+_rand_pool = secrets.token_bytes(_RAND_POOL_SIZE)
+_rand_pool_idx = 0
+_rand_pool_lock = threading.Lock()
+
+
+def _fast_hex(nbytes: int) -> str:
+    """Hex string of nbytes random bytes taken from the shared pool"""
+    global _rand_pool, _rand_pool_idx
+    with _rand_pool_lock:
+        if _rand_pool_idx + nbytes > _RAND_POOL_SIZE:
+            _rand_pool = secrets.token_bytes(_RAND_POOL_SIZE)
+            _rand_pool_idx = 0
+        start = _rand_pool_idx
+        _rand_pool_idx = start + nbytes
+        chunk = _rand_pool[start:start + nbytes]
+    return chunk.hex()
+
+
+# (refresh deadline, ISO string) for _coarse_iso_now; swapped as one tuple so
+# threads never see a deadline paired with another period's string
+_COARSE_ISO_PERIOD = 0.1
+_coarse_iso = (0.0, "")
+
+
+def _coarse_iso_now() -> str:
+    """Current UTC time as an ISO string, reformatted at most every 100 ms"""
+    global _coarse_iso
+    t = time.time()
+    deadline, value = _coarse_iso
+    if t >= deadline:
+        # Same format as _now_iso()
+        value = datetime.fromtimestamp(t, timezone.utc).isoformat()
+        _coarse_iso = (t + _COARSE_ISO_PERIOD, value)
+    return value
+
+
+def _compact_utc_stamp() -> str:
+    """Current UTC time as YYYYMMDDHHMMSS, formatted from integers"""
+    t = time.gmtime()
+    return (
+        f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}"
+        f"{t.tm_hour:02d}{t.tm_min:02d}{t.tm_sec:02d}"
+    )
+
+
+def _accounting_invoice_data(state: WorkflowState) -> Dict[str, Any]:
+    """
+    Invoice fields the accounting-entry prompt is built from. These are
+    exactly the fields accounting_cache_key() hashes (no invoice id), so a
+    cached result is valid for any invoice with the same contents.
+    """
+    payload = state.invoice_payload
+    return {
+        "amount": payload.amount,
+        "currency": payload.currency,
+        "vendor": state.prepare_output.vendor_profile.normalized_name,
+        "line_items": [
+            {"desc": item["desc"], "qty": item["qty"], "total": item["total"]}
+            for item in payload.line_items
+        ],
+    }
+
 
 def create_workflow_state(invoice_payload: InvoicePayload) -> WorkflowState:
     """Create initial workflow state"""
-    return WorkflowState(
+    # Every value here is already valid (the payload was validated on the way
+    # in), so skip re-validation; empty log/selection defaults are fresh copies.
+    now = _now_iso()
+    return WorkflowState.model_construct(
         workflow_id=str(uuid.uuid4()),
         current_stage=WorkflowStatusEnum.INTAKE,
-        created_at=datetime.utcnow().isoformat(),
-        updated_at=datetime.utcnow().isoformat(),
+        created_at=now,
+        updated_at=now,
         invoice_payload=invoice_payload,
-        execution_log=[],
-        tool_selections={},
     )
 
 
-def log_stage_execution(state: WorkflowState, stage: str, action: str, details: Dict[str, Any]) -> WorkflowState:
-    """Log stage execution"""
-    log_entry = AuditLogEntry(
-        timestamp=datetime.utcnow().isoformat(),
+def log_stage_execution(
+    state: WorkflowState, stage: str, action: str, details: Dict[str, Any],
+    timestamp: Optional[str] = None,
+) -> WorkflowState:
+    """Log stage execution; nodes that already stamped a time pass it in"""
+    # Built from node-local values only, so there is nothing to validate
+    log_entry = AuditLogEntry.model_construct(
+        timestamp=timestamp or _now_iso(),
         stage=stage,
         action=action,
         details=details,
     )
     state.execution_log.append(log_entry)
     
-    # Also persist to database
-    log_audit({
-        "id": str(uuid.uuid4()),
-        "workflow_id": state.workflow_id,
-        "invoice_id": state.invoice_payload.invoice_id if state.invoice_payload else "unknown",
-        "stage": stage,
-        "action": action,
-        "details": details,
-    })
-    
+    # Persisted in one batch by flush_audit_log() at the COMPLETE stage
     return state
 
 
+def flush_audit_log(state: WorkflowState, wait: bool = False) -> None:
+    """Hand the accumulated execution log to the background audit writer"""
+    invoice_id = state.invoice_payload.invoice_id if state.invoice_payload else "unknown"
+    # Position in the execution log is unique within a workflow, so ids sort
+    # in insertion order and need no random generation
+    audit_writer.submit([
+        {
+            "id": f"{state.workflow_id}:{seq:04d}",
+            "workflow_id": state.workflow_id,
+            "invoice_id": invoice_id,
+            "timestamp": datetime.fromisoformat(entry.timestamp),
+            "stage": entry.stage,
+            "action": entry.action,
+            "details": entry.details,
+        }
+        for seq, entry in enumerate(state.execution_log)
+    ], wait=wait)
+
+
 # ============================================================================
 # STAGE 1: INTAKE - Accept and validate invoice payload
 # ============================================================================
 def node_intake(state: WorkflowState) -> WorkflowState:
     """INTAKE Stage: Validate payload schema, persist raw invoice"""
-    logger.info(f"[INTAKE] Processing invoice: {state.invoice_payload.invoice_id}")
+    payload = state.invoice_payload
+    logger.info("[INTAKE] Processing invoice: %s", payload.invoice_id)
     
     # Select storage tool via Bigtool
-    storage_tool = BigtoolPicker.select("storage")
+    storage_tool = _DEFAULT_TOOLS["storage"]
     state.tool_selections["intake_storage"] = storage_tool
     
     # Validate schema (Pydantic already validates)
     raw_id = str(uuid.uuid4())
-    ingest_ts = datetime.utcnow().isoformat()
+    ingest_ts = _now_iso()
     
     state.intake_output = IntakeOutput(
         raw_id=raw_id,
@@ -89,55 +190,58 @@ def node_intake(state: WorkflowState) -> WorkflowState:
     state.current_stage = WorkflowStatusEnum.INTAKE
     state = log_stage_execution(
         state, "INTAKE", "invoice_validated",
-        {"raw_id": raw_id, "invoice_id": state.invoice_payload.invoice_id}
+        {"raw_id": raw_id, "invoice_id": payload.invoice_id},
+        ingest_ts,
     )
     
-    logger.info(f"[INTAKE] Completed: raw_id={raw_id}")
+    logger.info("[INTAKE] Completed: raw_id=%s", raw_id)
     return state
 
 
+# Simulated OCR output, filled from the payload's fields
+INVOICE_TEXT_TEMPLATE = """
+    Invoice from {vendor_name}
+    Invoice ID: {invoice_id}
+    Date: {invoice_date}
+    Due: {due_date}
+    Amount: {amount} {currency}
+    """
+
+
 # ============================================================================
 # STAGE 2: UNDERSTAND - OCR extraction and parsing
 # ============================================================================
 def node_understand(state: WorkflowState) -> WorkflowState:
     """UNDERSTAND Stage: Run OCR and parse line items"""
-    logger.info(f"[UNDERSTAND] Extracting invoice text")
+    payload = state.invoice_payload
+    logger.info("[UNDERSTAND] Extracting invoice text")
     
     # Select OCR tool via Bigtool
-    ocr_tool = BigtoolPicker.select_ocr_tool()
+    ocr_tool = _DEFAULT_TOOLS["ocr"]
     state.tool_selections["understand_ocr"] = ocr_tool
     
     # Simulate OCR extraction
-    invoice_text = f"""
-    Invoice from {state.invoice_payload.vendor_name}
-    Invoice ID: {state.invoice_payload.invoice_id}
-    Date: {state.invoice_payload.invoice_date}
-    Due: {state.invoice_payload.due_date}
-    Amount: {state.invoice_payload.amount} {state.invoice_payload.currency}
-    """
+    invoice_text = INVOICE_TEXT_TEMPLATE.format_map(payload.__dict__)
     
-    # Use LLM to extract structured data
-    extracted_data = gemini_llm.extract_invoice_text(invoice_text)
+    # One LLM round trip covers extraction and the PREPARE-stage vendor normalization
+    analysis = gemini_llm.process_invoice_all(invoice_text, payload.vendor_name)
+    state.llm_results["normalized_vendor"] = analysis["normalized_vendor"]
+    extracted_data = analysis["extracted"]
     
-    # Parse line items
+    # Parse line items; the payload's line items are already validated
     parsed_line_items = [
-        ParsedLineItem(
-            desc=item.desc,
-            qty=item.qty,
-            unit_price=item.unit_price,
-            total=item.total,
-        )
-        for item in state.invoice_payload.line_items
+        ParsedLineItem.model_construct(**item)
+        for item in payload.line_items
     ]
     
     parsed_invoice = ParsedInvoice(
         invoice_text=invoice_text,
         parsed_line_items=parsed_line_items,
         detected_pos=extracted_data.get("po_references", []),
-        currency=state.invoice_payload.currency,
+        currency=payload.currency,
         parsed_dates=ParsedDates(
-            invoice_date=state.invoice_payload.invoice_date,
-            due_date=state.invoice_payload.due_date,
+            invoice_date=payload.invoice_date,
+            due_date=payload.due_date,
         ),
     )
     
@@ -148,7 +252,7 @@ def node_understand(state: WorkflowState) -> WorkflowState:
         {"line_items_count": len(parsed_line_items), "ocr_tool": ocr_tool}
     )
     
-    logger.info(f"[UNDERSTAND] Completed: {len(parsed_line_items)} line items parsed")
+    logger.info("[UNDERSTAND] Completed: %d line items parsed", len(parsed_line_items))
     return state
 
 
@@ -157,39 +261,37 @@ def node_understand(state: WorkflowState) -> WorkflowState:
 # ============================================================================
 def node_prepare(state: WorkflowState) -> WorkflowState:
     """PREPARE Stage: Normalize vendor and enrich data"""
-    logger.info(f"[PREPARE] Normalizing vendor: {state.invoice_payload.vendor_name}")
+    payload = state.invoice_payload
+    logger.info("[PREPARE] Normalizing vendor: %s", payload.vendor_name)
     
     # Select enrichment tool via Bigtool
-    enrichment_tool = BigtoolPicker.select_enrichment_tool()
+    enrichment_tool = _DEFAULT_TOOLS["enrichment"]
     state.tool_selections["prepare_enrichment"] = enrichment_tool
     
-    # Normalize vendor name using LLM
-    normalized_name = gemini_llm.normalize_vendor_name(state.invoice_payload.vendor_name)
+    # Normalized vendor name comes from the UNDERSTAND-stage LLM call
+    normalized_name = state.llm_results.get("normalized_vendor")
+    if not normalized_name:
+        normalized_name = gemini_llm.normalize_vendor_name(payload.vendor_name)
+    
+    now = _now_iso()
     
     # Create vendor profile
     vendor_profile = VendorProfile(
         normalized_name=normalized_name,
-        tax_id=state.invoice_payload.vendor_tax_id,
+        tax_id=payload.vendor_tax_id,
         enrichment_meta=EnrichmentMeta(
             source=enrichment_tool,
             confidence=0.95,
-            enriched_at=datetime.utcnow().isoformat(),
+            enriched_at=now,
         ),
     )
     
     # Normalize invoice
     normalized_invoice = NormalizedInvoice(
-        amount=state.invoice_payload.amount,
-        currency=state.invoice_payload.currency,
-        line_items=[
-            ParsedLineItem(
-                desc=item.desc,
-                qty=item.qty,
-                unit_price=item.unit_price,
-                total=item.total,
-            )
-            for item in state.invoice_payload.line_items
-        ],
+        amount=payload.amount,
+        currency=payload.currency,
+        # Same items UNDERSTAND parsed; the models are frozen, so share them
+        line_items=state.understand_output.parsed_invoice.parsed_line_items,
     )
     
     # Compute flags
@@ -207,10 +309,11 @@ def node_prepare(state: WorkflowState) -> WorkflowState:
     state.current_stage = WorkflowStatusEnum.PREPARE
     state = log_stage_execution(
         state, "PREPARE", "vendor_enriched",
-        {"normalized_name": normalized_name, "enrichment_tool": enrichment_tool}
+        {"normalized_name": normalized_name, "enrichment_tool": enrichment_tool},
+        now,
     )
     
-    logger.info(f"[PREPARE] Completed: vendor normalized to '{normalized_name}'")
+    logger.info("[PREPARE] Completed: vendor normalized to '%s'", normalized_name)
     return state
 
 
@@ -219,34 +322,42 @@ def node_prepare(state: WorkflowState) -> WorkflowState:
 # ============================================================================
 def node_retrieve(state: WorkflowState) -> WorkflowState:
     """RETRIEVE Stage: Fetch POs and GRNs from ERP"""
-    logger.info(f"[RETRIEVE] Fetching POs and GRNs")
+    payload = state.invoice_payload
+    logger.info("[RETRIEVE] Fetching POs and GRNs")
     
     # Select ERP tool via Bigtool
-    erp_tool = BigtoolPicker.select_erp_tool()
+    erp_tool = _DEFAULT_TOOLS["erp_connector"]
     state.tool_selections["retrieve_erp"] = erp_tool
     
-    # Mock PO data
-    matched_pos = [
-        PurchaseOrder(
-            po_id="PO-2024-001",
-            vendor_id=state.invoice_payload.vendor_tax_id,
-            amount=state.invoice_payload.amount,
-            items=[
-                {"desc": item.desc, "qty": item.qty, "unit_price": item.unit_price}
-                for item in state.invoice_payload.line_items
-            ],
-        ),
-    ]
-    
-    # Mock GRN data
-    matched_grns = [
-        GoodsReceivedNote(
-            grn_id="GRN-2024-001",
-            po_id="PO-2024-001",
-            received_qty=sum(item.qty for item in state.invoice_payload.line_items),
-            received_date=datetime.utcnow().isoformat(),
-        ),
-    ]
+    # Blocking lookup: only POs sharing the vendor tax id or amount block
+    matched_pos = po_index.candidates(
+        payload.vendor_tax_id, payload.amount
+    )
+    matched_grns = po_index.grns_for(matched_pos)
+    
+    if not matched_pos:
+        # Mock PO data
+        matched_pos = [
+            PurchaseOrder(
+                po_id="PO-2024-001",
+                vendor_id=payload.vendor_tax_id,
+                amount=payload.amount,
+                items=[
+                    {"desc": item["desc"], "qty": item["qty"], "unit_price": item["unit_price"]}
+                    for item in payload.line_items
+                ],
+            ),
+        ]
+        
+        # Mock GRN data
+        matched_grns = [
+            GoodsReceivedNote(
+                grn_id="GRN-2024-001",
+                po_id="PO-2024-001",
+                received_qty=sum(item["qty"] for item in payload.line_items),
+                received_date=_now_iso(),
+            ),
+        ]
     
     state.retrieve_output = RetrieveOutput(
         matched_pos=matched_pos,
@@ -260,7 +371,7 @@ def node_retrieve(state: WorkflowState) -> WorkflowState:
         {"pos_count": len(matched_pos), "grns_count": len(matched_grns), "erp_tool": erp_tool}
     )
     
-    logger.info(f"[RETRIEVE] Completed: {len(matched_pos)} POs, {len(matched_grns)} GRNs")
+    logger.info("[RETRIEVE] Completed: %d POs, %d GRNs", len(matched_pos), len(matched_grns))
     return state
 
 
@@ -269,25 +380,31 @@ def node_retrieve(state: WorkflowState) -> WorkflowState:
 # ============================================================================
 def node_match_two_way(state: WorkflowState) -> WorkflowState:
     """MATCH_TWO_WAY Stage: Compute match score between invoice and PO"""
-    logger.info(f"[MATCH_TWO_WAY] Computing match score")
+    payload = state.invoice_payload
+    matched_pos = state.retrieve_output.matched_pos
+    logger.info("[MATCH_TWO_WAY] Computing match score")
     
     # Prepare invoice and PO data for matching
     invoice_data = {
-        "amount": state.invoice_payload.amount,
+        "amount": payload.amount,
         "vendor_name": state.prepare_output.vendor_profile.normalized_name,
+        "vendor_tax_id": payload.vendor_tax_id,
         "line_items": [
-            {"desc": item.desc, "qty": item.qty, "total": item.total}
-            for item in state.invoice_payload.line_items
+            {"desc": item["desc"], "qty": item["qty"], "total": item["total"]}
+            for item in payload.line_items
         ],
     }
     
+    po = matched_pos[0] if matched_pos else None
     po_data = {
-        "amount": state.retrieve_output.matched_pos[0].amount if state.retrieve_output.matched_pos else 0,
-        "vendor_id": state.retrieve_output.matched_pos[0].vendor_id if state.retrieve_output.matched_pos else "",
-        "items": state.retrieve_output.matched_pos[0].items if state.retrieve_output.matched_pos else [],
+        "amount": po.amount if po else 0,
+        "vendor_id": po.vendor_id if po else "",
+        "items": po.items if po else [],
     }
     
-    # Compute match score using LLM
+    # Compute match score using LLM. RECONCILE's accounting call is not
+    # started alongside it: a failed match would hold its checkpoint on, and
+    # pay for, entries that are only needed once the invoice is accepted.
     match_score = gemini_llm.compute_match_score(invoice_data, po_data)
     
     # Determine match result
@@ -298,7 +415,7 @@ def node_match_two_way(state: WorkflowState) -> WorkflowState:
     
     match_evidence = MatchEvidence(
         amount_match=abs(invoice_data["amount"] - po_data["amount"]) < 100,
-        po_match=len(state.retrieve_output.matched_pos) > 0,
+        po_match=len(matched_pos) > 0,
         vendor_match=True,
         details={"match_score": match_score},
     )
@@ -316,10 +433,20 @@ def node_match_two_way(state: WorkflowState) -> WorkflowState:
         {"match_score": match_score, "match_result": match_result.value}
     )
     
-    logger.info(f"[MATCH_TWO_WAY] Completed: match_score={match_score}, result={match_result.value}")
+    logger.info(
+        "[MATCH_TWO_WAY] Completed: match_score=%s, result=%s",
+        match_score, match_result.value,
+    )
     return state
 
 
+# Fields persisted in a checkpoint; enough to resume after the HITL decision
+CHECKPOINT_BLOB_FIELDS = {
+    "workflow_id", "invoice_payload", "intake_output", "understand_output",
+    "prepare_output", "retrieve_output", "match_two_way_output",
+}
+
+
 # ============================================================================
 # STAGE 6: CHECKPOINT_HITL - Save state if matching fails
 # ============================================================================
@@ -328,55 +455,49 @@ def node_checkpoint_hitl(state: WorkflowState) -> WorkflowState:
     
     # Only execute if match failed
     if state.match_two_way_output.match_result != MatchResultEnum.FAILED:
-        logger.info(f"[CHECKPOINT_HITL] Skipped: match succeeded")
+        logger.info("[CHECKPOINT_HITL] Skipped: match succeeded")
         return state
     
-    logger.info(f"[CHECKPOINT_HITL] Creating checkpoint for human review")
+    logger.info("[CHECKPOINT_HITL] Creating checkpoint for human review")
     
     # Select DB tool via Bigtool
-    db_tool = BigtoolPicker.select_db_tool()
+    db_tool = _DEFAULT_TOOLS["db"]
     state.tool_selections["checkpoint_db"] = db_tool
     
+    payload = state.invoice_payload
+    vendor_name = state.prepare_output.vendor_profile.normalized_name
     checkpoint_id = str(uuid.uuid4())
     review_url = f"http://localhost:8000/human-review/{checkpoint_id}"
     
-    # Prepare state blob for persistence
-    state_blob = {
-        "workflow_id": state.workflow_id,
-        "invoice_payload": state.invoice_payload.model_dump(),
-        "intake_output": state.intake_output.model_dump() if state.intake_output else None,
-        "understand_output": state.understand_output.model_dump() if state.understand_output else None,
-        "prepare_output": state.prepare_output.model_dump() if state.prepare_output else None,
-        "retrieve_output": state.retrieve_output.model_dump() if state.retrieve_output else None,
-        "match_two_way_output": state.match_two_way_output.model_dump() if state.match_two_way_output else None,
-    }
+    # Prepare state blob for persistence: one serializer walk over the
+    # resumable fields, encoded straight to the bytes the checkpoint row stores
+    state_blob = encode_state_blob(state.model_dump(include=CHECKPOINT_BLOB_FIELDS))
     
     # Save checkpoint to database
     checkpoint_data = {
         "checkpoint_id": checkpoint_id,
         "workflow_id": state.workflow_id,
-        "invoice_id": state.invoice_payload.invoice_id,
-        "vendor_name": state.prepare_output.vendor_profile.normalized_name,
-        "amount": state.invoice_payload.amount,
-        "currency": state.invoice_payload.currency,
+        "invoice_id": payload.invoice_id,
+        "vendor_name": vendor_name,
+        "amount": payload.amount,
+        "currency": payload.currency,
         "state_blob": state_blob,
         "reason_for_hold": f"Match score {state.match_two_way_output.match_score} below threshold {settings.MATCH_THRESHOLD}",
         "review_url": review_url,
     }
     
-    save_checkpoint(checkpoint_data)
-    
-    # Add to human review queue
-    add_to_review_queue({
+    # Checkpoint and its human review queue item are written in one transaction
+    save_checkpoint_with_queue(checkpoint_data, {
         "id": str(uuid.uuid4()),
         "checkpoint_id": checkpoint_id,
-        "invoice_id": state.invoice_payload.invoice_id,
-        "vendor_name": state.prepare_output.vendor_profile.normalized_name,
-        "amount": state.invoice_payload.amount,
-        "currency": state.invoice_payload.currency,
+        "invoice_id": payload.invoice_id,
+        "vendor_name": vendor_name,
+        "amount": payload.amount,
+        "currency": payload.currency,
         "reason_for_hold": checkpoint_data["reason_for_hold"],
         "review_url": review_url,
     })
+    invalidate_pending_reviews()
     
     state.checkpoint_hitl_output = CheckpointHitlOutput(
         checkpoint_id=checkpoint_id,
@@ -390,7 +511,7 @@ def node_checkpoint_hitl(state: WorkflowState) -> WorkflowState:
         {"checkpoint_id": checkpoint_id, "db_tool": db_tool}
     )
     
-    logger.info(f"[CHECKPOINT_HITL] Completed: checkpoint_id={checkpoint_id}")
+    logger.info("[CHECKPOINT_HITL] Completed: checkpoint_id=%s", checkpoint_id)
     return state
 
 
@@ -402,14 +523,17 @@ def node_hitl_decision(state: WorkflowState) -> WorkflowState:
     
     # Only execute if checkpoint was created
     if not state.checkpoint_hitl_output:
-        logger.info(f"[HITL_DECISION] Skipped: no checkpoint")
+        logger.info("[HITL_DECISION] Skipped: no checkpoint")
         return state
     
-    logger.info(f"[HITL_DECISION] Awaiting human decision for checkpoint: {state.checkpoint_hitl_output.checkpoint_id}")
+    logger.info(
+        "[HITL_DECISION] Awaiting human decision for checkpoint: %s",
+        state.checkpoint_hitl_output.checkpoint_id,
+    )
     
     # In a real implementation, this would wait for human input via API
     # For demo, we'll simulate acceptance
-    checkpoint = get_checkpoint(state.checkpoint_hitl_output.checkpoint_id)
+    checkpoint = get_checkpoint(state.checkpoint_hitl_output.checkpoint_id, include_state_blob=False)
     
     if checkpoint and checkpoint.get("decision"):
         human_decision = HumanDecisionEnum(checkpoint["decision"])
@@ -419,10 +543,7 @@ def node_hitl_decision(state: WorkflowState) -> WorkflowState:
         human_decision = HumanDecisionEnum.ACCEPT
         reviewer_id = "demo_reviewer"
     
-    next_stage = (
-        WorkflowStatusEnum.RECONCILE.value if human_decision == HumanDecisionEnum.ACCEPT
-        else WorkflowStatusEnum.COMPLETE.value
-    )
+    next_stage = HITL_NEXT_STAGE[human_decision]
     
     state.hitl_decision_output = HitlDecisionOutput(
         human_decision=human_decision,
@@ -437,73 +558,65 @@ def node_hitl_decision(state: WorkflowState) -> WorkflowState:
         {"decision": human_decision.value, "reviewer_id": reviewer_id}
     )
     
-    logger.info(f"[HITL_DECISION] Completed: decision={human_decision.value}")
+    logger.info("[HITL_DECISION] Completed: decision=%s", human_decision.value)
     return state
 
 
 # ============================================================================
 # STAGE 8: RECONCILE - Build accounting entries
 # ============================================================================
+def _parse_accounting_entry(entry: Dict[str, Any]) -> AccountingEntry:
+    """Validated accounting entry from one LLM-generated entry"""
+    return AccountingEntry(
+        account_code=entry.get("account_code", "5000"),
+        debit=entry.get("debit", 0.0),
+        credit=entry.get("credit", 0.0),
+        description=entry.get("description", "Invoice entry"),
+    )
+
+
 def node_reconcile(state: WorkflowState) -> WorkflowState:
     """RECONCILE Stage: Build accounting entries"""
     
     # Skip if human rejected
     if state.hitl_decision_output and state.hitl_decision_output.human_decision == HumanDecisionEnum.REJECT:
-        logger.info(f"[RECONCILE] Skipped: human rejected")
+        logger.info("[RECONCILE] Skipped: human rejected")
         return state
     
     # Skip if no match and no HITL decision
     if state.match_two_way_output.match_result == MatchResultEnum.FAILED and not state.hitl_decision_output:
-        logger.info(f"[RECONCILE] Skipped: awaiting HITL decision")
+        logger.info("[RECONCILE] Skipped: awaiting HITL decision")
         return state
     
-    logger.info(f"[RECONCILE] Building accounting entries")
+    logger.info("[RECONCILE] Building accounting entries")
     
-    # Prepare invoice data for accounting
-    invoice_data = {
-        "invoice_id": state.invoice_payload.invoice_id,
-        "amount": state.invoice_payload.amount,
-        "currency": state.invoice_payload.currency,
-        "vendor": state.prepare_output.vendor_profile.normalized_name,
-        "line_items": [
-            {"desc": item.desc, "qty": item.qty, "total": item.total}
-            for item in state.invoice_payload.line_items
-        ],
-    }
-    
-    # Generate accounting entries using LLM
-    acct_data = gemini_llm.generate_accounting_entries(invoice_data)
+    acct_data = gemini_llm.generate_accounting_entries(_accounting_invoice_data(state))
     
-    # Parse accounting entries
-    accounting_entries = [
-        AccountingEntry(
-            account_code=entry.get("account_code", "5000"),
-            debit=entry.get("debit", 0.0),
-            credit=entry.get("credit", 0.0),
-            description=entry.get("description", "Invoice entry"),
-        )
-        for entry in acct_data.get("entries", [])
-    ]
+    # Totals use math.fsum for any entry count: exactly rounded, so the
+    # balance check doesn't depend on how many entries the amounts arrive in
+    accounting_entries = [_parse_accounting_entry(entry) for entry in acct_data.get("entries", [])]
+    total_debits = math.fsum(map(attrgetter("debit"), accounting_entries))
+    total_credits = math.fsum(map(attrgetter("credit"), accounting_entries))
     
     # If no entries from LLM, create default
     if not accounting_entries:
+        amount = state.invoice_payload.amount
+        vendor_name = state.prepare_output.vendor_profile.normalized_name
         accounting_entries = [
             AccountingEntry(
                 account_code="2100",
                 debit=0.0,
-                credit=state.invoice_payload.amount,
-                description=f"AP for {state.prepare_output.vendor_profile.normalized_name}",
+                credit=amount,
+                description=f"AP for {vendor_name}",
             ),
             AccountingEntry(
                 account_code="5000",
-                debit=state.invoice_payload.amount,
+                debit=amount,
                 credit=0.0,
-                description=f"Expense from {state.prepare_output.vendor_profile.normalized_name}",
+                description=f"Expense from {vendor_name}",
             ),
         ]
-    
-    total_debits = sum(e.debit for e in accounting_entries)
-    total_credits = sum(e.credit for e in accounting_entries)
+        total_debits = total_credits = amount
     
     reconciliation_report = ReconciliationReport(
         total_debits=total_debits,
@@ -512,7 +625,8 @@ def node_reconcile(state: WorkflowState) -> WorkflowState:
         entries_count=len(accounting_entries),
     )
     
-    state.reconcile_output = ReconcileOutput(
+    # Entries were validated one by one above; the wrapper needn't re-walk them
+    state.reconcile_output = ReconcileOutput.model_construct(
         accounting_entries=accounting_entries,
         reconciliation_report=reconciliation_report,
     )
@@ -520,44 +634,57 @@ def node_reconcile(state: WorkflowState) -> WorkflowState:
     state.current_stage = WorkflowStatusEnum.RECONCILE
     state = log_stage_execution(
         state, "RECONCILE", "entries_created",
-        {"entries_count": len(accounting_entries), "balanced": reconciliation_report.balanced}
+        {"entries_count": len(accounting_entries), "balanced": reconciliation_report["balanced"]}
     )
     
-    logger.info(f"[RECONCILE] Completed: {len(accounting_entries)} entries, balanced={reconciliation_report.balanced}")
+    logger.info(
+        "[RECONCILE] Completed: %d entries, balanced=%s",
+        len(accounting_entries), reconciliation_report['balanced'],
+    )
     return state
 
 
 # ============================================================================
 # STAGE 9: APPROVE - Apply approval policies
 # ============================================================================
-def node_approve(state: WorkflowState) -> WorkflowState:
-    """APPROVE Stage: Apply approval policies"""
-    
-    # Skip if reconcile was skipped
-    if not state.reconcile_output:
-        logger.info(f"[APPROVE] Skipped: no reconciliation")
+def make_node_approve(auto_approve_threshold: float) -> Callable[[WorkflowState], WorkflowState]:
+    """APPROVE node with its threshold and approval rule bound once"""
+    determine_approval_status = gemini_llm.determine_approval_status
+    
+    def node_approve(state: WorkflowState) -> WorkflowState:
+        """APPROVE Stage: Apply approval policies"""
+        
+        # Skip if reconcile was skipped
+        if not state.reconcile_output:
+            logger.info("[APPROVE] Skipped: no reconciliation")
+            return state
+        
+        logger.info("[APPROVE] Applying approval policies")
+        
+        # A local threshold rule, not a remote call; nothing here to run concurrently
+        amount = state.invoice_payload.amount
+        approval_status = ApprovalStatusEnum(
+            determine_approval_status(amount, auto_approve_threshold)
+        )
+        
+        state.approve_output = ApproveOutput.model_construct(
+            approval_status=approval_status,
+            approver_id="system" if approval_status is ApprovalStatusEnum.AUTO_APPROVED else "manager_001",
+        )
+        
+        state.current_stage = WorkflowStatusEnum.APPROVE
+        state = log_stage_execution(
+            state, "APPROVE", "approval_determined",
+            {"approval_status": approval_status.value, "amount": amount}
+        )
+        
+        logger.info("[APPROVE] Completed: status=%s", approval_status.value)
         return state
     
-    logger.info(f"[APPROVE] Applying approval policies")
-    
-    approval_status = gemini_llm.determine_approval_status(
-        state.invoice_payload.amount,
-        settings.AUTO_APPROVE_THRESHOLD,
-    )
-    
-    state.approve_output = ApproveOutput(
-        approval_status=ApprovalStatusEnum(approval_status),
-        approver_id="system" if approval_status == "AUTO_APPROVED" else "manager_001",
-    )
-    
-    state.current_stage = WorkflowStatusEnum.APPROVE
-    state = log_stage_execution(
-        state, "APPROVE", "approval_determined",
-        {"approval_status": approval_status, "amount": state.invoice_payload.amount}
-    )
-    
-    logger.info(f"[APPROVE] Completed: status={approval_status}")
-    return state
+    return node_approve
+
+
+node_approve = make_node_approve(settings.AUTO_APPROVE_THRESHOLD)
 
 
 # ============================================================================
@@ -568,19 +695,19 @@ def node_posting(state: WorkflowState) -> WorkflowState:
     
     # Skip if approve was skipped
     if not state.approve_output:
-        logger.info(f"[POSTING] Skipped: no approval")
+        logger.info("[POSTING] Skipped: no approval")
         return state
     
-    logger.info(f"[POSTING] Posting to ERP")
+    logger.info("[POSTING] Posting to ERP")
     
     # Select ERP tool via Bigtool
-    erp_tool = BigtoolPicker.select_erp_tool()
+    erp_tool = _DEFAULT_TOOLS["erp_connector"]
     state.tool_selections["posting_erp"] = erp_tool
     
-    erp_txn_id = f"TXN-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
-    payment_id = f"PAY-{uuid.uuid4().hex[:8]}"
+    erp_txn_id = f"TXN-{_compact_utc_stamp()}-{_fast_hex(3)}"
+    payment_id = f"PAY-{_fast_hex(4)}"
     
-    state.posting_output = PostingOutput(
+    state.posting_output = PostingOutput.model_construct(
         posted=True,
         erp_txn_id=erp_txn_id,
         scheduled_payment_id=payment_id,
@@ -592,7 +719,7 @@ def node_posting(state: WorkflowState) -> WorkflowState:
         {"erp_txn_id": erp_txn_id, "payment_id": payment_id, "erp_tool": erp_tool}
     )
     
-    logger.info(f"[POSTING] Completed: txn_id={erp_txn_id}")
+    logger.info("[POSTING] Completed: txn_id=%s", erp_txn_id)
     return state
 
 
@@ -604,13 +731,13 @@ def node_notify(state: WorkflowState) -> WorkflowState:
     
     # Skip if posting was skipped
     if not state.posting_output:
-        logger.info(f"[NOTIFY] Skipped: no posting")
+        logger.info("[NOTIFY] Skipped: no posting")
         return state
     
-    logger.info(f"[NOTIFY] Sending notifications")
+    logger.info("[NOTIFY] Sending notifications")
     
     # Select email tool via Bigtool
-    email_tool = BigtoolPicker.select_email_tool()
+    email_tool = _DEFAULT_TOOLS["email"]
     state.tool_selections["notify_email"] = email_tool
     
     notify_status = NotifyStatus(
@@ -622,7 +749,7 @@ def node_notify(state: WorkflowState) -> WorkflowState:
         },
     )
     
-    state.notify_output = NotifyOutput(
+    state.notify_output = NotifyOutput.model_construct(
         notify_status=notify_status,
         notified_parties=[
             state.prepare_output.vendor_profile.normalized_name,
@@ -636,7 +763,10 @@ def node_notify(state: WorkflowState) -> WorkflowState:
         {"parties": state.notify_output.notified_parties, "email_tool": email_tool}
     )
     
-    logger.info(f"[NOTIFY] Completed: notified {len(state.notify_output.notified_parties)} parties")
+    logger.info(
+        "[NOTIFY] Completed: notified %d parties",
+        len(state.notify_output.notified_parties),
+    )
     return state
 
 
@@ -645,71 +775,75 @@ def node_notify(state: WorkflowState) -> WorkflowState:
 # ============================================================================
 def node_complete(state: WorkflowState) -> WorkflowState:
     """COMPLETE Stage: Produce final payload and audit log"""
-    logger.info(f"[COMPLETE] Finalizing workflow")
+    logger.info("[COMPLETE] Finalizing workflow")
     
     # Select DB tool via Bigtool
-    db_tool = BigtoolPicker.select_db_tool()
+    db_tool = _DEFAULT_TOOLS["db"]
     state.tool_selections["complete_db"] = db_tool
     
-    final_payload = FinalPayload(
+    # Built from upstream stage outputs that were validated when produced,
+    # so the final models skip validation (notably re-walking the audit log).
+    # posted_at only needs 100 ms resolution; the audit entry keeps full precision.
+    final_payload = FinalPayload.model_construct(
         invoice_id=state.invoice_payload.invoice_id,
         vendor_name=state.prepare_output.vendor_profile.normalized_name if state.prepare_output else state.invoice_payload.vendor_name,
         amount=state.invoice_payload.amount,
         currency=state.invoice_payload.currency,
         status=WorkflowStatusEnum.COMPLETE,
         erp_txn_id=state.posting_output.erp_txn_id if state.posting_output else "N/A",
-        posted_at=datetime.utcnow().isoformat(),
+        posted_at=_coarse_iso_now(),
         accounting_entries=state.reconcile_output.accounting_entries if state.reconcile_output else [],
     )
     
-    state.complete_output = CompleteOutput(
+    state.complete_output = CompleteOutput.model_construct(
         final_payload=final_payload,
-        audit_log=state.execution_log,
+        # A copy: the COMPLETE entry logged below is not part of the output
+        audit_log=list(state.execution_log),
         status=WorkflowStatusEnum.COMPLETE,
     )
     
     state.current_stage = WorkflowStatusEnum.COMPLETE
     state = log_stage_execution(
         state, "COMPLETE", "workflow_completed",
-        {"invoice_id": state.invoice_payload.invoice_id, "db_tool": db_tool}
+        {"invoice_id": state.invoice_payload.invoice_id, "db_tool": db_tool},
     )
+    # A completed workflow's audit trail is durable before it is reported; the
+    # write shares its commit with other workflows finishing at the same time
+    flush_audit_log(state, wait=True)
     
-    logger.info(f"[COMPLETE] Workflow completed for invoice {state.invoice_payload.invoice_id}")
+    logger.info("[COMPLETE] Workflow completed for invoice %s", state.invoice_payload.invoice_id)
     return state
 
 
 # ============================================================================
 # Conditional routing logic
 # ============================================================================
-def should_checkpoint(state: WorkflowState) -> str:
-    """Determine if we should create checkpoint"""
-    if state.match_two_way_output and state.match_two_way_output.match_result == MatchResultEnum.FAILED:
-        return "checkpoint"
-    return "skip_checkpoint"
-
-
-def should_hitl_decision(state: WorkflowState) -> str:
-    """Determine if we should wait for HITL decision"""
-    if state.checkpoint_hitl_output:
-        return "hitl_decision"
-    return "skip_hitl"
-
-
-def should_reconcile(state: WorkflowState) -> str:
-    """Determine if we should reconcile"""
-    if state.reconcile_output:
-        return "reconcile"
-    if state.hitl_decision_output and state.hitl_decision_output.human_decision == HumanDecisionEnum.ACCEPT:
-        return "reconcile"
-    return "skip_reconcile"
-
-
+# Next node after a routing point, keyed by (match succeeded, human decision).
+# The decision is None until HITL_DECISION has run; a rejected invoice goes
+# straight to COMPLETE instead of passing through the stages that skip it.
+ROUTES = {
+    (True, None): "reconcile",
+    (False, None): "checkpoint_hitl",
+    (False, HumanDecisionEnum.ACCEPT): "reconcile",
+    (False, HumanDecisionEnum.REJECT): "complete",
+}
+
+
+def route(state: WorkflowState) -> str:
+    """Next node after MATCH_TWO_WAY or HITL_DECISION"""
+    decision = state.hitl_decision_output
+    return ROUTES[
+        state.match_two_way_output.match_result is not MatchResultEnum.FAILED,
+        decision.human_decision if decision else None,
+    ]
 
 
 # Create the compiled workflow
 def create_compiled_workflow():
     """Create and return the compiled workflow"""
     workflow = StateGraph(WorkflowState)
+    # Settings are frozen for the life of the process; bind them per graph
+    auto_approve_threshold = settings.AUTO_APPROVE_THRESHOLD
     
     # Add all nodes
     workflow.add_node("intake", node_intake)
@@ -720,7 +854,7 @@ def create_compiled_workflow():
     workflow.add_node("checkpoint_hitl", node_checkpoint_hitl)
     workflow.add_node("hitl_decision", node_hitl_decision)
     workflow.add_node("reconcile", node_reconcile)
-    workflow.add_node("approve", node_approve)
+    workflow.add_node("approve", make_node_approve(auto_approve_threshold))
     workflow.add_node("posting", node_posting)
     workflow.add_node("notify", node_notify)
     workflow.add_node("complete", node_complete)
@@ -734,21 +868,16 @@ def create_compiled_workflow():
     workflow.add_edge("prepare", "retrieve")
     workflow.add_edge("retrieve", "match_two_way")
     
-    # Conditional edge after match
-    workflow.add_conditional_edges(
-        "match_two_way",
-        should_checkpoint,
-        {
-            "checkpoint": "checkpoint_hitl",
-            "skip_checkpoint": "reconcile",
-        },
-    )
+    # Conditional edge after match. A matched invoice already goes straight to
+    # RECONCILE, so known-good invoices never touch the checkpoint/HITL nodes
+    # and need no separate specialized graph.
+    workflow.add_conditional_edges("match_two_way", route, ["checkpoint_hitl", "reconcile"])
     
     # Checkpoint to HITL
     workflow.add_edge("checkpoint_hitl", "hitl_decision")
     
-    # HITL to reconcile
-    workflow.add_edge("hitl_decision", "reconcile")
+    # HITL to reconcile, or straight to complete on rejection
+    workflow.add_conditional_edges("hitl_decision", route, ["reconcile", "complete"])
     
     # Continue flow
     workflow.add_edge("reconcile", "approve")